@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+from functools import lru_cache
 import uuid
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from decimal import Decimal, ROUND_DOWN
+import time
 from typing import Any
 
-from fastapi import APIRouter, Depends, HTTPException, Request, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session, load_only
 
 from .btcpay_schemas import (
     BtcpayInvoiceCreate,
@@ -14,13 +17,13 @@ from .btcpay_schemas import (
     BtcpayWebhookCreate,
     BtcpayWebhookUpdate,
 )
-from .btcpay_webhooks import dispatch_btcpay_webhooks
+from .btcpay_webhooks import dispatch_btcpay_webhooks, invalidate_hooks_cache
 from .config import INVOICE_DEFAULT_EXPIRY_HOURS
 from .config import QR_STORAGE_DIR
-from .db import get_db
+from .db import SessionLocal, get_db
 from .formatting import format_xmr_amount
 from .models import BtcpayWebhook, Invoice, InvoiceTransfer, User
-from .rates import get_xmr_rate
+from .rates import fiat_to_xmr, get_xmr_rate
 from .security import (
     decrypt_api_key,
     encrypt_secret,
@@ -36,6 +39,9 @@ router = APIRouter()
 
 BTCPAY_PAYMENT_METHOD = "XMR-CHAIN"
 BTCPAY_PAYMENT_METHOD_ALIASES = {BTCPAY_PAYMENT_METHOD, "XMR", "XMR_CHAIN"}
+_MANUAL_MARKING_STATUSES = ("Invalid",)
+_ATOMIC_UNITS_PER_XMR = 10**12
+_ATOMIC_PER_XMR = Decimal(_ATOMIC_UNITS_PER_XMR)
 BTCPAY_WEBHOOK_EVENTS = {
     "InvoiceCreated",
     "InvoiceReceivedPayment",
@@ -70,35 +76,37 @@ def _require_store(store_id: str, user: User) -> str:
     return store_id
 
 
+_STORE_EXPIRY_MINUTES = max(1, INVOICE_DEFAULT_EXPIRY_HOURS * 60)
+_STORE_TEMPLATE: dict[str, Any] = {
+    "name": "XMR Checkout",
+    "website": "",
+    "defaultCurrency": "XMR",
+    "invoiceExpiration": _STORE_EXPIRY_MINUTES,
+    "displayExpirationTimer": True,
+    "monitoringExpiration": _STORE_EXPIRY_MINUTES,
+    "speedPolicy": "MediumSpeed",
+    "paymentTolerance": 0,
+    "anyoneCanCreateInvoice": False,
+    "requiresRefundEmail": False,
+    "lightningAmountInSatoshi": False,
+    "lightningPrivateRouteHints": False,
+    "onChainWithLnInvoiceFallback": False,
+    "redirectAutomatically": False,
+    "showRecommendedFee": False,
+    "recommendedFeeBlockTarget": 0,
+    "defaultLang": "en",
+    "customLogo": "",
+    "customCSS": "",
+    "htmlTitle": "XMR Checkout",
+    "networkFeeMode": "Never",
+    "payJoinEnabled": False,
+    "lazyPaymentMethods": False,
+    "defaultPaymentMethod": BTCPAY_PAYMENT_METHOD,
+}
+
+
 def _store_payload(user: User) -> dict[str, Any]:
-    expiry_minutes = max(1, INVOICE_DEFAULT_EXPIRY_HOURS * 60)
-    return {
-        "id": str(user.id),
-        "name": "XMR Checkout",
-        "website": "",
-        "defaultCurrency": "XMR",
-        "invoiceExpiration": expiry_minutes,
-        "displayExpirationTimer": True,
-        "monitoringExpiration": expiry_minutes,
-        "speedPolicy": "MediumSpeed",
-        "paymentTolerance": 0,
-        "anyoneCanCreateInvoice": False,
-        "requiresRefundEmail": False,
-        "lightningAmountInSatoshi": False,
-        "lightningPrivateRouteHints": False,
-        "onChainWithLnInvoiceFallback": False,
-        "redirectAutomatically": False,
-        "showRecommendedFee": False,
-        "recommendedFeeBlockTarget": 0,
-        "defaultLang": "en",
-        "customLogo": "",
-        "customCSS": "",
-        "htmlTitle": "XMR Checkout",
-        "networkFeeMode": "Never",
-        "payJoinEnabled": False,
-        "lazyPaymentMethods": False,
-        "defaultPaymentMethod": BTCPAY_PAYMENT_METHOD,
-    }
+    return {"id": str(user.id), **_STORE_TEMPLATE}
 
 
 def _invoice_checkout_link(invoice: Invoice, request: Request) -> str:
@@ -109,6 +117,7 @@ def _invoice_checkout_link(invoice: Invoice, request: Request) -> str:
     return f"{proto}://{host}/i/{invoice.id}"
 
 
+@lru_cache(maxsize=64)
 def _normalize_btcpay_payment_method(value: str) -> str:
     normalized = value.strip().upper()
     if normalized in BTCPAY_PAYMENT_METHOD_ALIASES:
@@ -142,9 +151,7 @@ def _resolve_btcpay_amount(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Fiat quote service unavailable",
         ) from exc
-    amount_xmr = (Decimal(amount) / quote.rate).quantize(
-        Decimal("0.000000000001"), rounding=ROUND_DOWN
-    )
+    amount_xmr = fiat_to_xmr(amount, quote)
     quote_payload = {
         "fiat_amount": str(amount),
         "fiat_currency": quote.currency,
@@ -195,10 +202,7 @@ def _after_expiration(invoice: Invoice) -> bool:
 
 
 def _xmr_to_atomic(amount: Decimal) -> int:
-    quantized = (Decimal(amount) * Decimal("1000000000000")).to_integral_value(
-        rounding=ROUND_DOWN
-    )
-    return int(quantized)
+    return int((Decimal(amount) * _ATOMIC_PER_XMR).to_integral_value(rounding=ROUND_DOWN))
 
 
 def _btcpay_amount_currency(invoice: Invoice) -> tuple[str, str, dict[str, Any]]:
@@ -212,29 +216,45 @@ def _btcpay_amount_currency(invoice: Invoice) -> tuple[str, str, dict[str, Any]]
     return format_xmr_amount(invoice.amount_xmr), "XMR", {}
 
 
-def _format_xmr_fixed(value: Decimal) -> str:
-    return f"{value.quantize(Decimal('0.000000000001')):.12f}"
+def _format_atomic_fixed(value: int) -> str:
+    sign = "-" if value < 0 else ""
+    whole, fraction = divmod(abs(value), _ATOMIC_UNITS_PER_XMR)
+    return f"{sign}{whole}.{fraction:012d}"
 
 
-def _atomic_to_xmr(value: int) -> Decimal:
-    return (Decimal(value) / Decimal("1000000000000")).quantize(
-        Decimal("0.000000000001"), rounding=ROUND_DOWN
-    )
+def _finalize_created_invoice(invoice_id: uuid.UUID, user_id: str) -> None:
+    db = SessionLocal()
+    try:
+        invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+        if invoice is None:
+            return
+        try:
+            ensure_invoice_qr_png(
+                invoice=invoice,
+                storage_dir=QR_STORAGE_DIR,
+                settings=resolve_qr_settings(invoice),
+            )
+        except HTTPException:
+            pass
+        dispatch_webhooks(db, user_id, "invoice.created", invoice)
+        dispatch_btcpay_webhooks(db, user_id, "InvoiceCreated", invoice)
+    finally:
+        db.close()
 
 
 @router.get("/api/v1/stores")
-def list_stores(user: User = Depends(_require_btcpay_user)):
+async def list_stores(user: User = Depends(_require_btcpay_user)):
     return [_store_payload(user)]
 
 
 @router.get("/api/v1/stores/{store_id}")
-def get_store(store_id: str, user: User = Depends(_require_btcpay_user)):
+async def get_store(store_id: str, user: User = Depends(_require_btcpay_user)):
     _require_store(store_id, user)
     return _store_payload(user)
 
 
 @router.get("/api/v1/stores/{store_id}/payment-methods")
-def list_payment_methods(store_id: str, user: User = Depends(_require_btcpay_user)):
+async def list_payment_methods(store_id: str, user: User = Depends(_require_btcpay_user)):
     _require_store(store_id, user)
     return [
         {
@@ -251,6 +271,7 @@ def create_invoice(
     store_id: str,
     payload: BtcpayInvoiceCreate,
     request: Request,
+    background_tasks: BackgroundTasks,
     user: User = Depends(_require_btcpay_user),
     db: Session = Depends(get_db),
 ):
@@ -267,30 +288,26 @@ def create_invoice(
             detail="Unsupported payment method",
         )
     amount_xmr, quote_payload = _resolve_btcpay_amount(payload.amount, payload.currency)
-    expires_at = None
-    now = datetime.now(timezone.utc)
     expiration_minutes = None
     monitoring_minutes = None
     if checkout and checkout.expirationMinutes:
         expiration_minutes = int(checkout.expirationMinutes)
     if expiration_minutes:
-        expires_at = now + timedelta(minutes=expiration_minutes)
+        expiration_seconds = expiration_minutes * 60
     else:
-        expires_at = now + timedelta(hours=INVOICE_DEFAULT_EXPIRY_HOURS)
+        expiration_seconds = INVOICE_DEFAULT_EXPIRY_HOURS * 3600
+    expires_at_ns = time.time_ns() + expiration_seconds * 1_000_000_000
+    expires_at = datetime.fromtimestamp(expires_at_ns / 1_000_000_000, timezone.utc)
     if checkout and checkout.monitoringMinutes is not None:
         monitoring_minutes = int(checkout.monitoringMinutes)
     metadata: dict[str, Any] = dict(payload.metadata or {})
-    btcpay_data = metadata.get("btcpay") if isinstance(metadata.get("btcpay"), dict) else {}
-    btcpay_data = dict(btcpay_data)
-    btcpay_data.update(
-        {
-            "amount": str(payload.amount),
-            "currency": payload.currency,
-            "checkout": checkout.model_dump(mode="json") if checkout else None,
-            "expiration_minutes": expiration_minutes,
-            "monitoring_minutes": monitoring_minutes,
-        }
-    )
+    existing_btcpay = metadata.get("btcpay")
+    btcpay_data = dict(existing_btcpay) if isinstance(existing_btcpay, dict) else {}
+    btcpay_data["amount"] = str(payload.amount)
+    btcpay_data["currency"] = payload.currency
+    btcpay_data["checkout"] = checkout.model_dump(mode="json") if checkout else None
+    btcpay_data["expiration_minutes"] = expiration_minutes
+    btcpay_data["monitoring_minutes"] = monitoring_minutes
     metadata["btcpay"] = btcpay_data
     if quote_payload and "quote" not in metadata:
         metadata["quote"] = quote_payload
@@ -313,23 +330,15 @@ def create_invoice(
         metadata_json=metadata,
         expires_at=expires_at,
     )
+    # Subaddress allocation only flushes, so the allocation and the insert
+    # share this single commit.
     db.add(invoice)
     db.commit()
     db.refresh(invoice)
-    try:
-        ensure_invoice_qr_png(
-            invoice=invoice,
-            storage_dir=QR_STORAGE_DIR,
-            settings=resolve_qr_settings(invoice),
-        )
-    except HTTPException:
-        pass
-    dispatch_webhooks(db, str(user.id), "invoice.created", invoice)
-    dispatch_btcpay_webhooks(db, str(user.id), "InvoiceCreated", invoice)
+    background_tasks.add_task(_finalize_created_invoice, invoice.id, str(user.id))
     status_name, additional_status = _btcpay_status(invoice)
     amount, currency, _ = _btcpay_amount_currency(invoice)
-    expiration_time = _epoch_seconds(invoice.expires_at)
-    monitoring_time = expiration_time
+    expiration_time = expires_at_ns // 1_000_000_000
     if monitoring_minutes is None:
         monitoring_minutes = 60
     monitoring_time = expiration_time + int(monitoring_minutes * 60)
@@ -345,7 +354,7 @@ def create_invoice(
         "archived": False,
         "status": status_name,
         "additionalStatus": additional_status,
-        "availableStatusesForManualMarking": ["Invalid"],
+        "availableStatusesForManualMarking": _MANUAL_MARKING_STATUSES,
     }
 
 
@@ -358,23 +367,19 @@ def get_invoice(
     db: Session = Depends(get_db),
 ):
     _require_store(store_id, user)
-    try:
-        invoice_uuid = uuid.UUID(invoice_id)
-    except ValueError:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
-        )
-    invoice = (
-        db.query(Invoice)
-        .filter(Invoice.id == invoice_uuid, Invoice.user_id == user.id)
-        .first()
+    invoice = _get_invoice(
+        db,
+        invoice_id,
+        user,
+        Invoice.amount_xmr,
+        Invoice.status,
+        Invoice.total_paid_atomic,
+        Invoice.metadata_json,
+        Invoice.created_at,
+        Invoice.archived_at,
+        Invoice.expires_at,
+        Invoice.detected_at,
     )
-    if invoice is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
-        )
     status_name, additional_status = _btcpay_status(invoice)
     amount, currency, btcpay_data = _btcpay_amount_currency(invoice)
     expiration_time = _epoch_seconds(invoice.expires_at)
@@ -398,7 +403,7 @@ def get_invoice(
         "archived": invoice.archived_at is not None,
         "status": status_name,
         "additionalStatus": additional_status,
-        "availableStatusesForManualMarking": ["Invalid"],
+        "availableStatusesForManualMarking": _MANUAL_MARKING_STATUSES,
     }
 
 
@@ -410,34 +415,43 @@ def get_invoice_payment_methods(
     db: Session = Depends(get_db),
 ):
     _require_store(store_id, user)
-    try:
-        invoice_uuid = uuid.UUID(invoice_id)
-    except ValueError:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
-        )
-    invoice = (
-        db.query(Invoice)
-        .filter(Invoice.id == invoice_uuid, Invoice.user_id == user.id)
-        .first()
+    invoice = _get_invoice(
+        db,
+        invoice_id,
+        user,
+        Invoice.address,
+        Invoice.amount_xmr,
+        Invoice.confirmation_target,
+        Invoice.metadata_json,
+        Invoice.created_at,
     )
-    if invoice is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
+    total_atomic = (
+        db.query(func.coalesce(func.sum(InvoiceTransfer.amount_atomic), 0))
+        .filter(
+            InvoiceTransfer.invoice_id == invoice.id,
+            InvoiceTransfer.amount_atomic > 0,
         )
+        .scalar()
+    )
     transfers = (
         db.query(InvoiceTransfer)
-        .filter(InvoiceTransfer.invoice_id == invoice.id)
+        .with_entities(
+            InvoiceTransfer.txid,
+            InvoiceTransfer.amount_atomic,
+            InvoiceTransfer.confirmations,
+            InvoiceTransfer.timestamp,
+            InvoiceTransfer.address,
+        )
+        .filter(
+            InvoiceTransfer.invoice_id == invoice.id,
+            InvoiceTransfer.amount_atomic > 0,
+        )
         .order_by(InvoiceTransfer.created_at.asc())
         .all()
     )
-    total_atomic = sum(
-        transfer.amount_atomic for transfer in transfers if transfer.amount_atomic > 0
-    )
-    total_paid = _atomic_to_xmr(total_atomic)
-    due = max(Decimal("0"), invoice.amount_xmr - total_paid)
+    total_atomic = int(total_atomic)
+    required_atomic = _xmr_to_atomic(invoice.amount_xmr)
+    due_atomic = max(0, required_atomic - total_atomic)
     metadata = invoice.metadata_json or {}
     quote = metadata.get("quote") if isinstance(metadata, dict) else None
     rate_value = "0"
@@ -446,8 +460,6 @@ def get_invoice_payment_methods(
     payments = []
     created_fallback = _epoch_seconds(invoice.created_at)
     for transfer in transfers:
-        if transfer.amount_atomic <= 0:
-            continue
         confirmations = transfer.confirmations
         status_label = (
             "confirmed"
@@ -457,7 +469,7 @@ def get_invoice_payment_methods(
         payments.append(
             {
                 "id": f"{transfer.txid}-0",
-                "value": _format_xmr_fixed(_atomic_to_xmr(transfer.amount_atomic)),
+                "value": _format_atomic_fixed(transfer.amount_atomic),
                 "fee": "0",
                 "destination": transfer.address or invoice.address,
                 "status": status_label,
@@ -471,10 +483,10 @@ def get_invoice_payment_methods(
             "cryptoCode": "XMR",
             "destination": invoice.address,
             "rate": rate_value,
-            "amount": _format_xmr_fixed(invoice.amount_xmr),
-            "due": _format_xmr_fixed(due),
-            "totalPaid": _format_xmr_fixed(total_paid),
-            "paymentMethodPaid": _format_xmr_fixed(total_paid),
+            "amount": _format_atomic_fixed(required_atomic),
+            "due": _format_atomic_fixed(due_atomic),
+            "totalPaid": _format_atomic_fixed(total_atomic),
+            "paymentMethodPaid": _format_atomic_fixed(total_atomic),
             "networkFee": "0",
             "payments": payments,
         }
@@ -495,32 +507,27 @@ def mark_invoice_status(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Unsupported status",
         )
-    try:
-        invoice_uuid = uuid.UUID(invoice_id)
-    except ValueError:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
+    invoice_uuid = _parse_uuid(invoice_id, "Invoice not found")
+    invoice = db.execute(
+        update(Invoice)
+        .where(
+            Invoice.id == invoice_uuid,
+            Invoice.user_id == user.id,
+            Invoice.status != "confirmed",
         )
-    invoice = (
-        db.query(Invoice)
-        .filter(Invoice.id == invoice_uuid, Invoice.user_id == user.id)
-        .first()
-    )
+        .values(status="invalid")
+        .returning(Invoice)
+    ).scalar_one_or_none()
     if invoice is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Invoice not found",
-        )
-    if invoice.status == "confirmed":
+        _get_invoice(db, invoice_id, user, Invoice.status)
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Confirmed invoices cannot be marked invalid",
         )
-    invoice.status = "invalid"
-    db.add(invoice)
+    # RETURNING already loaded the updated row; detach it so the commit does
+    # not expire it and force a reload for the webhook payload.
+    db.expunge(invoice)
     db.commit()
-    db.refresh(invoice)
     dispatch_btcpay_webhooks(
         db,
         str(user.id),
@@ -551,6 +558,7 @@ def create_webhook(
     )
     db.add(webhook)
     db.commit()
+    invalidate_hooks_cache(str(user.id))
     db.refresh(webhook)
     return _webhook_response(webhook, include_secret=True, secret=secret)
 
@@ -605,6 +613,7 @@ def update_webhook(
         hook.authorized_events = payload.authorizedEvents.model_dump()
     db.add(hook)
     db.commit()
+    invalidate_hooks_cache(str(user.id))
     db.refresh(hook)
     return _webhook_response(hook)
 
@@ -623,11 +632,12 @@ def delete_webhook(
     hook = _get_webhook(db, webhook_id, user)
     db.delete(hook)
     db.commit()
+    invalidate_hooks_cache(str(user.id))
     return None
 
 
 @router.get("/api/v1/server/info")
-def server_info():
+async def server_info():
     return {
         "version": "1.7.5",
         "onion": None,
@@ -637,7 +647,7 @@ def server_info():
 
 
 @router.get("/api/v1/api-keys/current")
-def api_key_current(
+async def api_key_current(
     user: User = Depends(_require_btcpay_user),
 ):
     store_id = str(user.id)
@@ -654,14 +664,32 @@ def api_key_current(
     }
 
 
-def _get_webhook(db: Session, webhook_id: str, user: User) -> BtcpayWebhook:
+def _parse_uuid(value: str, not_found_detail: str) -> uuid.UUID:
     try:
-        webhook_uuid = uuid.UUID(webhook_id)
+        return uuid.UUID(value)
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Webhook not found",
+            detail=not_found_detail,
+        )
+
+
+def _get_invoice(db: Session, invoice_id: str, user: User, *columns: Any) -> Invoice:
+    invoice_uuid = _parse_uuid(invoice_id, "Invoice not found")
+    query = db.query(Invoice)
+    if columns:
+        query = query.options(load_only(*columns))
+    invoice = query.filter(Invoice.id == invoice_uuid, Invoice.user_id == user.id).first()
+    if invoice is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Invoice not found",
         )
+    return invoice
+
+
+def _get_webhook(db: Session, webhook_id: str, user: User) -> BtcpayWebhook:
+    webhook_uuid = _parse_uuid(webhook_id, "Webhook not found")
     hook = (
         db.query(BtcpayWebhook)
         .filter(BtcpayWebhook.id == webhook_uuid, BtcpayWebhook.user_id == user.id)
@@ -44,6 +44,7 @@ class BtcpayWebhookEvents(BaseModel):
     def _validate_selection(self) -> "BtcpayWebhookEvents":
         if not self.everything and not self.specificEvents:
             raise ValueError("Select at least one event")
+        self.specificEvents = [] if self.everything else sorted(set(self.specificEvents))
         return self
 
 
@@ -1,23 +1,88 @@
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 import hashlib
 import hmac
 import json
 import logging
+import random
+import threading
 import time
 from datetime import datetime, timezone
 from urllib.parse import urljoin
 
+import orjson
 import requests
 from requests import RequestException
+from sqlalchemy import Row
 from sqlalchemy.orm import Session
 
+from .http_client import http_session
 from .models import BtcpayWebhook, Invoice
 from .security import decrypt_secret
 
 logger = logging.getLogger(__name__)
 
 _REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+_PERMANENT_REDIRECT_STATUSES = {301, 308}
+_RESOLVED_URL_TTL_SECONDS = 3600
+_RESOLVED_URLS_MAX = 4096
+_MAX_DISPATCH_WORKERS = 16
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_MAX_ATTEMPTS = 3
+_RETRY_BASE_DELAY_SECONDS = 0.5
+_RETRY_MAX_DELAY_SECONDS = 4.0
+_RETRY_BUDGET_SECONDS = 10.0
+_CIRCUIT_FAILURE_THRESHOLD = 5
+_CIRCUIT_WINDOW_SECONDS = 60
+_CIRCUIT_OPEN_SECONDS = 30
+# invalidate_hooks_cache only reaches the process that changed the hooks. Other gunicorn
+# workers and the reconciler's outbox thread can keep posting to a removed or disabled
+# hook, or signing with a rotated secret, until their entry expires; keep this short.
+_HOOKS_CACHE_TTL_SECONDS = 5
+_HOOKS_CACHE_MAX_USERS = 10_000
+
+
+@dataclass
+class _CircuitState:
+    failures: int
+    window_started_at: float
+    open_until: float = 0.0
+
+
+_circuit_lock = threading.Lock()
+_circuits: dict[str, _CircuitState] = {}
+
+
+@dataclass(frozen=True, slots=True)
+class _HookTarget:
+    id: str
+    url: str
+    secret_encrypted: str
+    everything: bool
+    specific_events: frozenset[str]
+
+    def allows(self, event_type: str) -> bool:
+        return self.everything or event_type in self.specific_events
+
+
+_hooks_cache_lock = threading.Lock()
+_hooks_cache: dict[str, tuple[tuple[_HookTarget, ...], float]] = {}
+
+_resolved_urls_lock = threading.Lock()
+_resolved_urls: dict[str, tuple[str, float]] = {}
+
+# Each hook gets a serial lane so its events arrive in order, while a slow or dead
+# endpoint only holds up its own lane: hook id -> deliveries waiting behind the one
+# in flight. A lane exists while a pool thread is draining it.
+_lanes_lock = threading.Lock()
+_lanes: dict[str, deque[tuple[_HookTarget, str, bytes, Future[None]]]] = {}
+_delivery_pool = ThreadPoolExecutor(
+    max_workers=_MAX_DISPATCH_WORKERS, thread_name_prefix="btcpay-delivery"
+)
 
 
 def dispatch_btcpay_webhooks(
@@ -28,74 +93,172 @@ def dispatch_btcpay_webhooks(
     *,
     manually_marked: bool = False,
 ) -> None:
-    hooks = (
-        db.query(BtcpayWebhook)
-        .filter(
-            BtcpayWebhook.user_id == user_id,
-            BtcpayWebhook.enabled.is_(True),
-        )
-        .all()
-    )
+    hooks = _get_hooks(db, user_id)
     if not hooks:
         return
-    payload = _build_payload(
+    payload = build_btcpay_payload(
         event_type=event_type,
         user_id=user_id,
         invoice=invoice,
         manually_marked=manually_marked,
     )
-    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
-    for hook in hooks:
-        if not _event_allowed(hook.authorized_events, event_type):
-            continue
+    _enqueue_payload(hooks, payload)
+
+
+def queue_btcpay_body(
+    db: Session,
+    user_id: str,
+    event_type: str,
+    body: bytes,
+) -> list[Future[None]]:
+    # Each future resolves once its hook's delivery attempt has finished.
+    hooks = _get_hooks(db, user_id)
+    return [_enqueue(hook, event_type, body) for hook in hooks if hook.allows(event_type)]
+
+
+def _enqueue_payload(
+    hooks: tuple[_HookTarget, ...],
+    payload: dict[str, object],
+) -> None:
+    event_type = str(payload["type"])
+    targets = [hook for hook in hooks if hook.allows(event_type)]
+    if not targets:
+        return
+    body = encode_btcpay_body(payload)
+    for hook in targets:
+        _enqueue(hook, event_type, body)
+
+
+def _enqueue(hook: _HookTarget, event_type: str, body: bytes) -> Future[None]:
+    delivered: Future[None] = Future()
+    item = (hook, event_type, body, delivered)
+    with _lanes_lock:
+        lane = _lanes.get(hook.id)
+        if lane is not None:
+            lane.append(item)
+            return delivered
+        _lanes[hook.id] = deque((item,))
+    _delivery_pool.submit(_drain_lane, hook.id)
+    return delivered
+
+
+def _drain_lane(hook_id: str) -> None:
+    while True:
+        with _lanes_lock:
+            lane = _lanes[hook_id]
+            if not lane:
+                del _lanes[hook_id]
+                return
+            hook, event_type, body, delivered = lane.popleft()
         try:
-            secret = decrypt_secret(hook.secret_encrypted)
-            signature = _sign_payload(body, secret)
-            headers = {
-                "BTCPay-Sig": f"sha256={signature}",
-                "Content-Type": "application/json",
-                "User-Agent": "xmrcheckout-btcpay-webhook/1.0",
-            }
-            response = _post_with_redirects(
-                hook.url,
-                data=body,
-                headers=headers,
-                timeout=5,
-            )
-            if response is None:
-                continue
-            if response.status_code >= 400:
-                logger.warning(
-                    "BTCPay webhook delivered non-success status",
-                    extra={
-                        "webhook_id": str(hook.id),
-                        "event": event_type,
-                        "http_status": response.status_code,
-                    },
-                )
-        except RequestException as exc:
-            logger.warning(
-                "BTCPay webhook delivery failed",
-                extra={"webhook_id": str(hook.id), "event": event_type},
-            )
-            logger.debug("BTCPay webhook delivery error: %s", exc)
-        except Exception as exc:
+            _deliver(hook, event_type, body)
+        finally:
+            delivered.set_result(None)
+
+
+def invalidate_hooks_cache(user_id: str) -> None:
+    with _hooks_cache_lock:
+        _hooks_cache.pop(user_id, None)
+
+
+def _get_hooks(db: Session, user_id: str) -> tuple[_HookTarget, ...]:
+    now = time.monotonic()
+    with _hooks_cache_lock:
+        cached = _hooks_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+    rows = (
+        db.query(BtcpayWebhook)
+        .with_entities(
+            BtcpayWebhook.id,
+            BtcpayWebhook.url,
+            BtcpayWebhook.authorized_events,
+            BtcpayWebhook.secret_encrypted,
+        )
+        .filter(
+            BtcpayWebhook.user_id == user_id,
+            BtcpayWebhook.enabled.is_(True),
+        )
+        .all()
+    )
+    hooks = tuple(_hook_target(row) for row in rows)
+    with _hooks_cache_lock:
+        _hooks_cache.pop(user_id, None)
+        if len(_hooks_cache) >= _HOOKS_CACHE_MAX_USERS:
+            _hooks_cache.pop(next(iter(_hooks_cache)))
+        _hooks_cache[user_id] = (hooks, now + _HOOKS_CACHE_TTL_SECONDS)
+    return hooks
+
+
+def _hook_target(row: Row) -> _HookTarget:
+    authorized_events = row.authorized_events
+    everything = False
+    specific_events: frozenset[str] = frozenset()
+    if isinstance(authorized_events, dict):
+        everything = authorized_events.get("everything") is True
+        specific_events = frozenset(authorized_events.get("specificEvents") or [])
+    return _HookTarget(
+        id=str(row.id),
+        url=row.url,
+        secret_encrypted=row.secret_encrypted,
+        everything=everything,
+        specific_events=specific_events,
+    )
+
+
+def _deliver(hook: _HookTarget, event_type: str, body: bytes) -> None:
+    if _circuit_open(hook.url):
+        logger.warning(
+            "BTCPay webhook skipped while endpoint is failing",
+            extra={"webhook_id": hook.id, "event": event_type},
+        )
+        return
+    try:
+        signature = _sign_payload(body, hook.secret_encrypted)
+        headers = {
+            "BTCPay-Sig": f"sha256={signature}",
+            "Content-Type": "application/json",
+            "User-Agent": "xmrcheckout-btcpay-webhook/1.0",
+        }
+        response = _post_with_retries(
+            hook.url,
+            data=body,
+            headers=headers,
+            timeout=5,
+        )
+        if response is None:
+            return
+        if response.status_code >= 400:
             logger.warning(
-                "BTCPay webhook dispatch failed",
-                extra={"webhook_id": str(hook.id), "event": event_type, "error": str(exc)},
+                "BTCPay webhook delivered non-success status",
+                extra={
+                    "webhook_id": hook.id,
+                    "event": event_type,
+                    "http_status": response.status_code,
+                },
             )
+    except RequestException as exc:
+        logger.warning(
+            "BTCPay webhook delivery failed",
+            extra={"webhook_id": hook.id, "event": event_type},
+        )
+        logger.debug("BTCPay webhook delivery error: %s", exc)
+    except Exception as exc:
+        logger.warning(
+            "BTCPay webhook dispatch failed",
+            extra={"webhook_id": hook.id, "event": event_type, "error": str(exc)},
+        )
 
 
-def _event_allowed(authorized_events: object, event_type: str) -> bool:
-    if not isinstance(authorized_events, dict):
-        return False
-    if authorized_events.get("everything") is True:
-        return True
-    specific = authorized_events.get("specificEvents") or []
-    return event_type in specific
+def encode_btcpay_body(payload: dict[str, object]) -> bytes:
+    try:
+        return orjson.dumps(payload)
+    except orjson.JSONEncodeError:
+        # orjson rejects integers wider than 64 bits, which merchant metadata may carry.
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
 
 
-def _build_payload(
+def build_btcpay_payload(
     *,
     event_type: str,
     user_id: str,
@@ -104,7 +267,7 @@ def _build_payload(
 ) -> dict[str, object]:
     return {
         "type": event_type,
-        "timestamp": int(time.time()),
+        "timestamp": time.time_ns() // 1_000_000_000,
         "storeId": user_id,
         "invoiceId": str(invoice.id),
         "manuallyMarked": manually_marked,
@@ -127,8 +290,75 @@ def _after_expiration(invoice: Invoice) -> bool:
     return detected_at > expires_at
 
 
-def _sign_payload(body: bytes, secret: str) -> str:
-    return hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+@lru_cache(maxsize=1024)
+def _hmac_template(secret_encrypted: str) -> hmac.HMAC:
+    # Keyed by ciphertext, so a rotated secret gets a fresh entry.
+    return hmac.new(decrypt_secret(secret_encrypted).encode("utf-8"), b"", hashlib.sha256)
+
+
+def _sign_payload(body: bytes, secret_encrypted: str) -> str:
+    # Copying a keyed template skips the key schedule that hmac.digest() redoes
+    # on every call; both run on OpenSSL since digestmod is hashlib.sha256.
+    mac = _hmac_template(secret_encrypted).copy()
+    mac.update(body)
+    return mac.hexdigest()
+
+
+def _post_with_retries(
+    url: str,
+    *,
+    data: bytes,
+    headers: dict[str, str],
+    timeout: int,
+) -> requests.Response | None:
+    # Retries hold this hook's lane, so the whole attempt sequence is capped and a
+    # retry is only made when it can still finish inside the budget.
+    deadline = time.monotonic() + _RETRY_BUDGET_SECONDS
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        error: RequestException | None = None
+        response = None
+        try:
+            response = _post_with_redirects(url, data=data, headers=headers, timeout=timeout)
+        except RequestException as exc:
+            error = exc
+        if error is None and (response is None or response.status_code not in _RETRY_STATUSES):
+            _record_success(url)
+            return response
+        delay = random.uniform(
+            0, min(_RETRY_MAX_DELAY_SECONDS, _RETRY_BASE_DELAY_SECONDS * 2**attempt)
+        )
+        if attempt == _MAX_ATTEMPTS or time.monotonic() + delay + timeout > deadline:
+            _record_failure(url)
+            if error is not None:
+                raise error
+            return response
+        time.sleep(delay)
+    return None
+
+
+def _circuit_open(url: str) -> bool:
+    with _circuit_lock:
+        state = _circuits.get(url)
+        return state is not None and time.monotonic() < state.open_until
+
+
+def _record_failure(url: str) -> None:
+    now = time.monotonic()
+    with _circuit_lock:
+        state = _circuits.get(url)
+        if state is None or now - state.window_started_at > _CIRCUIT_WINDOW_SECONDS:
+            state = _CircuitState(failures=0, window_started_at=now)
+            _circuits[url] = state
+        state.failures += 1
+        if state.failures >= _CIRCUIT_FAILURE_THRESHOLD:
+            state.open_until = now + _CIRCUIT_OPEN_SECONDS
+            state.failures = 0
+            state.window_started_at = now
+
+
+def _record_success(url: str) -> None:
+    with _circuit_lock:
+        _circuits.pop(url, None)
 
 
 def _post_with_redirects(
@@ -139,9 +369,11 @@ def _post_with_redirects(
     timeout: int,
     max_redirects: int = 3,
 ) -> requests.Response | None:
-    current_url = url
+    current_url = _resolved_url(url)
+    redirected = False
+    permanent = True
     for _ in range(max_redirects + 1):
-        response = requests.post(
+        response = http_session.post(
             current_url,
             data=data,
             headers=headers,
@@ -149,9 +381,37 @@ def _post_with_redirects(
             allow_redirects=False,
         )
         if response.status_code not in _REDIRECT_STATUSES:
+            if redirected and permanent:
+                _remember_resolved_url(url, current_url)
             return response
+        if not redirected and current_url != url:
+            # The cached target redirects too, so later sends start from the original URL.
+            _forget_resolved_url(url)
         location = response.headers.get("Location")
         if not location:
             return response
+        redirected = True
+        permanent = permanent and response.status_code in _PERMANENT_REDIRECT_STATUSES
         current_url = urljoin(current_url, location)
     return None
+
+
+def _resolved_url(url: str) -> str:
+    with _resolved_urls_lock:
+        cached = _resolved_urls.get(url)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+    return url
+
+
+def _forget_resolved_url(url: str) -> None:
+    with _resolved_urls_lock:
+        _resolved_urls.pop(url, None)
+
+
+def _remember_resolved_url(url: str, resolved_url: str) -> None:
+    with _resolved_urls_lock:
+        _resolved_urls.pop(url, None)
+        if len(_resolved_urls) >= _RESOLVED_URLS_MAX:
+            _resolved_urls.pop(next(iter(_resolved_urls)))
+        _resolved_urls[url] = (resolved_url, time.monotonic() + _RESOLVED_URL_TTL_SECONDS)
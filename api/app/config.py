@@ -16,32 +16,37 @@ def _get_env(name: str, default: str | None = None) -> str:
 
 
 DATABASE_URL = _get_env("DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
 
-API_KEYS = [
+API_KEYS = frozenset(
     key.strip()
     for key in os.getenv("API_KEYS", "").split(",")
     if key.strip()
-]
+)
 
 API_KEY_ENCRYPTION_KEY = _get_env("API_KEY_ENCRYPTION_KEY")
 INVOICE_RECONCILE_INTERVAL_SECONDS = int(os.getenv("INVOICE_RECONCILE_INTERVAL_SECONDS", "30"))
 INVOICE_DEFAULT_EXPIRY_HOURS = int(os.getenv("INVOICE_DEFAULT_EXPIRY_HOURS", "1"))
 LATE_PAYMENT_LOOKBACK_HOURS = int(os.getenv("LATE_PAYMENT_LOOKBACK_HOURS", "48"))
+RECONCILE_WORKERS = max(1, int(os.getenv("RECONCILE_WORKERS", "4")))
 DONATION_EXPIRY_MINUTES = int(os.getenv("DONATION_EXPIRY_MINUTES", "30"))
 DONATION_ACTIVE_INVOICE_LIMIT = int(os.getenv("DONATION_ACTIVE_INVOICE_LIMIT", "25"))
 COINGECKO_API_KEY = os.getenv("COINGECKO_API_KEY", "")
 DONATIONS_ENABLED = _get_bool_env("DONATIONS_ENABLED", False)
 
-MONERO_WALLET_RPC_URLS = [
+MONERO_WALLET_RPC_URLS = tuple(
     url.strip()
     for url in os.getenv("MONERO_WALLET_RPC_URLS", "").split(",")
     if url.strip()
-]
+)
 MONERO_WALLET_RPC_USER = os.getenv("MONERO_WALLET_RPC_USER", "")
 MONERO_WALLET_RPC_PASSWORD = os.getenv("MONERO_WALLET_RPC_PASSWORD", "")
 MONERO_WALLET_RPC_WALLET_PASSWORD = os.getenv("MONERO_WALLET_RPC_WALLET_PASSWORD", "")
 MONERO_DAEMON_URL = os.getenv("MONERO_DAEMON_URL")
 MONERO_WALLET_RPC_WALLET_DIR = os.getenv("MONERO_WALLET_RPC_WALLET_DIR", "")
+MONERO_WALLET_RPC_BATCH_SIZE = max(1, int(os.getenv("MONERO_WALLET_RPC_BATCH_SIZE", "500")))
 FOUNDER_PAYMENT_ADDRESS = os.getenv("FOUNDER_PAYMENT_ADDRESS", "")
 FOUNDER_VIEW_KEY = os.getenv("FOUNDER_VIEW_KEY", "")
 QR_STORAGE_DIR = os.getenv("QR_STORAGE_DIR", "/qr")
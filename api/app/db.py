@@ -1,9 +1,38 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.orm import declarative_base, sessionmaker
 
-from .config import DATABASE_URL
+from .config import (
+    DATABASE_URL,
+    DB_POOL_MAX_OVERFLOW,
+    DB_POOL_RECYCLE_SECONDS,
+    DB_POOL_SIZE,
+)
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+_PSYCOPG_PREPARE_THRESHOLD = 5
+
+
+def _engine_url(database_url: str) -> URL:
+    url = make_url(database_url)
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+psycopg")
+    return url
+
+
+_url = _engine_url(DATABASE_URL)
+_connect_args = (
+    {"prepare_threshold": _PSYCOPG_PREPARE_THRESHOLD}
+    if _url.drivername == "postgresql+psycopg"
+    else {}
+)
+engine = create_engine(
+    _url,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE_SECONDS,
+    pool_pre_ping=True,
+    connect_args=_connect_args,
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
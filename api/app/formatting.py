@@ -1,7 +1,23 @@
 from decimal import Decimal
 
+_ATOMIC_PER_XMR = 10**12
+_ATOMIC_PER_XMR_DECIMAL = Decimal(_ATOMIC_PER_XMR)
+
+
+def format_xmr_atomic(atomic: int) -> str:
+    sign = "-" if atomic < 0 else ""
+    whole, frac = divmod(abs(atomic), _ATOMIC_PER_XMR)
+    if not frac:
+        return f"{sign}{whole}"
+    return f"{sign}{whole}.{frac:012d}".rstrip("0")
+
 
 def format_xmr_amount(value: Decimal) -> str:
+    if value.is_finite():
+        scaled = value * _ATOMIC_PER_XMR_DECIMAL
+        atomic = int(scaled)
+        if atomic == scaled:
+            return format_xmr_atomic(atomic)
     normalized = value.normalize()
     formatted = format(normalized, "f")
     if "." in formatted:
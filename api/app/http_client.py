@@ -0,0 +1,9 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+# One pooled session for all outbound HTTP (webhooks, rates, daemon) so keep-alive
+# connections are reused across calls and threads.
+http_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+http_session.mount("http://", _adapter)
+http_session.mount("https://", _adapter)
@@ -0,0 +1,111 @@
+import logging
+
+from sqlalchemy import text
+
+from . import models  # noqa: F401
+from .db import Base, engine
+
+logger = logging.getLogger(__name__)
+
+_LOCK_ID = 894221741
+
+_SCHEMA_STATEMENTS = (
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS user_id UUID",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS wallet_address VARCHAR",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS subaddress_index INTEGER",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS confirmations INTEGER DEFAULT 0",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS total_paid_atomic BIGINT",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS paid_after_expiry BOOLEAN DEFAULT false",
+    "ALTER TABLE invoices "
+    "ADD COLUMN IF NOT EXISTS paid_after_expiry_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITH TIME ZONE",
+    "UPDATE invoices SET confirmations = 0 WHERE confirmations IS NULL",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_user_id ON invoices (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_wallet_address ON invoices (wallet_address)",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_user_id_id ON invoices (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_user_id_created_at "
+    "ON invoices (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_open_or_late ON invoices (status, expires_at) "
+    "WHERE status IN ('pending', 'payment_detected', 'expired')",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_user_id_active ON invoices (user_id, expires_at) "
+    "WHERE status IN ('pending', 'payment_detected')",
+    "CREATE INDEX IF NOT EXISTS ix_btcpay_webhooks_user_id_id "
+    "ON btcpay_webhooks (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_btcpay_webhooks_user_enabled "
+    "ON btcpay_webhooks (user_id) WHERE enabled",
+    # The partial index above serves the enabled-hooks lookup, so the older full
+    # (user_id, enabled) and (user_id) indexes are only cleaned up here.
+    "DROP INDEX IF EXISTS ix_btcpay_webhooks_user_id_enabled",
+    "DROP INDEX IF EXISTS ix_btcpay_webhooks_user_id",
+    "ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS user_id UUID",
+    "ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS event_urls JSON",
+    "ALTER TABLE webhooks ALTER COLUMN url DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_webhooks_user_id ON webhooks (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_webhook_deliveries_user_id "
+    "ON webhook_deliveries (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_webhook_deliveries_webhook_id "
+    "ON webhook_deliveries (webhook_id)",
+    "ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS invoice_id UUID",
+    "ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS invoice_address VARCHAR",
+    "ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS invoice_subaddress_index INTEGER",
+    "ALTER TABLE webhook_deliveries "
+    "ADD COLUMN IF NOT EXISTS invoice_amount_xmr NUMERIC(18, 12)",
+    "ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS invoice_status VARCHAR",
+    "ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS payload JSON",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS payment_address VARCHAR",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS view_key_encrypted VARCHAR",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS webhook_secret_encrypted VARCHAR",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS next_subaddress_index INTEGER DEFAULT 1",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS subaddress_start_index INTEGER DEFAULT 0",
+    "ALTER TABLE users "
+    "ADD COLUMN IF NOT EXISTS default_confirmation_target INTEGER DEFAULT 1",
+    "ALTER TABLE users ALTER COLUMN default_confirmation_target SET DEFAULT 1",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS default_qr_logo VARCHAR DEFAULT 'monero'",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS default_qr_logo_data_url VARCHAR",
+    "ALTER TABLE users "
+    "ADD COLUMN IF NOT EXISTS btcpay_checkout_style VARCHAR DEFAULT 'btcpay_classic'",
+    "ALTER TABLE users ALTER COLUMN btcpay_checkout_style SET DEFAULT 'btcpay_classic'",
+    "ALTER TABLE users "
+    "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()",
+    "UPDATE users SET btcpay_checkout_style = 'btcpay_classic' "
+    "WHERE btcpay_checkout_style IS NULL",
+    "UPDATE users "
+    "SET btcpay_checkout_style = 'btcpay_classic' "
+    "WHERE btcpay_checkout_style = 'standard' "
+    "AND NOT EXISTS ("
+    "  SELECT 1 FROM profile_history ph "
+    "  WHERE ph.user_id = users.id AND ph.field_name = 'btcpay_checkout_style'"
+    ")",
+    "UPDATE users SET default_confirmation_target = 1 "
+    "WHERE default_confirmation_target IS NULL",
+    "UPDATE users SET default_qr_logo = 'monero' WHERE default_qr_logo IS NULL",
+    "CREATE INDEX IF NOT EXISTS ix_users_payment_address ON users (payment_address)",
+)
+
+
+def migrate() -> None:
+    lock_acquired = False
+    with engine.begin() as connection:
+        try:
+            connection.execute(text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": _LOCK_ID})
+            lock_acquired = True
+        except Exception:
+            lock_acquired = False
+        try:
+            Base.metadata.create_all(bind=connection)
+            connection.exec_driver_sql(";\n".join(_SCHEMA_STATEMENTS))
+        finally:
+            if lock_acquired:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": _LOCK_ID}
+                )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    migrate()
+    logger.info("Database schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,12 @@ from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
+    Index,
     Integer,
     Numeric,
     String,
     UniqueConstraint,
+    text,
 )
 from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.sql import func
@@ -19,6 +21,22 @@ from .db import Base
 
 class Invoice(Base):
     __tablename__ = "invoices"
+    __table_args__ = (
+        Index("ix_invoices_user_id_id", "user_id", "id"),
+        Index("ix_invoices_user_id_created_at", "user_id", "created_at"),
+        Index(
+            "ix_invoices_open_or_late",
+            "status",
+            "expires_at",
+            postgresql_where=text("status IN ('pending', 'payment_detected', 'expired')"),
+        ),
+        Index(
+            "ix_invoices_user_id_active",
+            "user_id",
+            "expires_at",
+            postgresql_where=text("status IN ('pending', 'payment_detected')"),
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=True, index=True)
@@ -79,9 +97,17 @@ class Webhook(Base):
 
 class BtcpayWebhook(Base):
     __tablename__ = "btcpay_webhooks"
+    __table_args__ = (
+        Index("ix_btcpay_webhooks_user_id_id", "user_id", "id"),
+        Index(
+            "ix_btcpay_webhooks_user_enabled",
+            "user_id",
+            postgresql_where=text("enabled"),
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    user_id = Column(UUID(as_uuid=True), nullable=False)
     url = Column(String, nullable=False)
     enabled = Column(Boolean, nullable=False, default=True)
     automatic_redelivery = Column(Boolean, nullable=False, default=True)
@@ -114,6 +140,19 @@ class WebhookDelivery(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
+class WebhookOutbox(Base):
+    __tablename__ = "webhook_outbox"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(UUID(as_uuid=True), nullable=False)
+    invoice_id = Column(UUID(as_uuid=True), nullable=False)
+    event = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    btcpay_payloads = Column(JSON, nullable=False)
+    claimed_until = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class User(Base):
     __tablename__ = "users"
 
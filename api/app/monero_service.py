@@ -1,8 +1,12 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 import hashlib
+from itertools import chain
 import logging
+import threading
 import time
 from urllib.parse import urlparse
 
@@ -15,17 +19,37 @@ from requests.auth import HTTPDigestAuth
 
 from .config import (
     MONERO_DAEMON_URL,
+    MONERO_WALLET_RPC_BATCH_SIZE,
     MONERO_WALLET_RPC_PASSWORD,
     MONERO_WALLET_RPC_URLS,
     MONERO_WALLET_RPC_USER,
     MONERO_WALLET_RPC_WALLET_PASSWORD,
     MONERO_WALLET_RPC_WALLET_DIR,
 )
+from .http_client import http_session
 from .models import User
 from .security import decrypt_secret
 
 logger = logging.getLogger(__name__)
 
+_ADDRESS_INDEX_CACHE_MAX = 10_000
+_DAEMON_HEIGHT_TTL_SECONDS = 30
+
+
+@lru_cache(maxsize=4096)
+def _wallet_name(user_id: str, payment_address: str, view_key: str) -> str:
+    fingerprint = hashlib.sha256(
+        f"{payment_address}:{view_key}".encode("utf-8")
+    ).hexdigest()[:12]
+    return f"user-{user_id}-{fingerprint}"
+
+
+# Kept on SHA-256 so wallets stay pinned to the backend that already holds them open.
+@lru_cache(maxsize=4096)
+def _backend_slot(wallet_name: str, backend_count: int) -> int:
+    digest = hashlib.sha256(wallet_name.encode("utf-8")).digest()
+    return int.from_bytes(digest, "big") % backend_count
+
 
 def _normalize_daemon_address(value: str | None) -> str | None:
     if not value:
@@ -47,13 +71,13 @@ def _normalize_daemon_url(value: str | None) -> str | None:
     return f"http://{value.rstrip('/')}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SubaddressResult:
     address: str
     address_index: int | None
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class TransferDetail:
     txid: str
     amount_atomic: int
@@ -67,6 +91,11 @@ class WalletBackend:
     client: JSONRPCWallet
     url: str
     current_wallet: str | None = None
+    # set_daemon applies to the open wallet only, so remember which wallet it was sent for.
+    daemon_set_for: str | None = None
+    # Subaddress indices never change once created, so lookups are kept per wallet.
+    address_indices: dict[tuple[str, str], tuple[int, int]] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
 
 
 class MoneroWalletService:
@@ -97,13 +126,17 @@ class MoneroWalletService:
         self._daemon_url = _normalize_daemon_url(MONERO_DAEMON_URL)
         self._daemon_address = _normalize_daemon_address(MONERO_DAEMON_URL)
         self._wallet_dir = MONERO_WALLET_RPC_WALLET_DIR.strip()
+        self._daemon_height_lock = threading.Lock()
+        self._daemon_height_cache: tuple[int, float] | None = None
 
     def get_status(self) -> dict[str, str]:
-        for backend in self._backends:
-            try:
-                backend.client.raw_request("get_version")
-            except Exception:
-                return {"wallet_rpc": "unreachable"}
+        if len(self._backends) > 1:
+            with ThreadPoolExecutor(max_workers=len(self._backends)) as executor:
+                reachable = list(executor.map(self._wallet_rpc_reachable, self._backends))
+        else:
+            reachable = [self._wallet_rpc_reachable(backend) for backend in self._backends]
+        if not all(reachable):
+            return {"wallet_rpc": "unreachable"}
 
         if self._daemon_address:
             try:
@@ -117,46 +150,63 @@ class MoneroWalletService:
                     return {"wallet_rpc": "ok", "daemon": "unreachable"}
         return {"wallet_rpc": "ok", "daemon": "ok" if self._daemon_address else "unknown"}
 
+    def warm_up(self) -> None:
+        # HTTPDigestAuth keeps the server nonce per thread and replays it, so one call from
+        # the polling thread saves the 401 challenge on that thread's first real request.
+        for backend in self._backends:
+            self._wallet_rpc_reachable(backend)
+
+    @staticmethod
+    def _wallet_rpc_reachable(backend: WalletBackend) -> bool:
+        try:
+            backend.client.raw_request("get_version")
+        except Exception:
+            return False
+        return True
+
     def create_subaddress(self, user: User, label: str) -> SubaddressResult:
         start_total = time.monotonic()
         view_key = decrypt_secret(user.view_key_encrypted)
         wallet_name = self._wallet_name(user, user.payment_address, view_key)
         backend = self._backend_for_wallet_name(wallet_name)
-        start_wallet = time.monotonic()
-        self._ensure_wallet_open(
-            backend=backend,
-            wallet_name=wallet_name,
-            payment_address=user.payment_address,
-            view_key=view_key,
-        )
-        wallet_elapsed = time.monotonic() - start_wallet
-        start_daemon = time.monotonic()
-        self._ensure_daemon(backend)
-        daemon_elapsed = time.monotonic() - start_daemon
-
-        start_create = time.monotonic()
-        try:
-            response = backend.client.raw_request(
-                "create_address",
-                {"account_index": 0, "label": label},
+        # A wallet-rpc process has one open wallet, so callers take turns per backend.
+        with backend.lock:
+            start_wallet = time.monotonic()
+            self._ensure_wallet_open(
+                backend=backend,
+                wallet_name=wallet_name,
+                payment_address=user.payment_address,
+                view_key=view_key,
             )
-        except (RPCError, RequestException) as exc:
-            self._raise_wallet_rpc_error(exc)
-        create_elapsed = time.monotonic() - start_create
-        address = response.get("address")
-        if not address:
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail="Monero wallet RPC did not return a subaddress",
-            )
-        start_store = time.monotonic()
-        try:
-            backend.client.raw_request("store")
-        except RPCError:
-            # Storing can fail if the wallet RPC is in an odd state; the
-            # subaddress is still valid, but we prefer to surface issues later.
-            pass
-        store_elapsed = time.monotonic() - start_store
+            wallet_elapsed = time.monotonic() - start_wallet
+            start_daemon = time.monotonic()
+            self._ensure_daemon(backend)
+            daemon_elapsed = time.monotonic() - start_daemon
+
+            start_create = time.monotonic()
+            try:
+                response = backend.client.raw_request(
+                    "create_address",
+                    {"account_index": 0, "label": label},
+                )
+            except (RPCError, RequestException) as exc:
+                backend.daemon_set_for = None
+                self._raise_wallet_rpc_error(exc)
+            create_elapsed = time.monotonic() - start_create
+            address = response.get("address")
+            if not address:
+                raise HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail="Monero wallet RPC did not return a subaddress",
+                )
+            start_store = time.monotonic()
+            try:
+                backend.client.raw_request("store")
+            except RPCError:
+                # Storing can fail if the wallet RPC is in an odd state; the
+                # subaddress is still valid, but we prefer to surface issues later.
+                pass
+            store_elapsed = time.monotonic() - start_store
         total_elapsed = time.monotonic() - start_total
         logger.info(
             "create_subaddress timing wallet=%.3fs daemon=%.3fs create=%.3fs store=%.3fs total=%.3fs",
@@ -175,57 +225,12 @@ class MoneroWalletService:
         self,
         user: User,
         address: str,
+        address_index: int | None = None,
     ) -> tuple[int, int]:
-        view_key = decrypt_secret(user.view_key_encrypted)
-        wallet_name = self._wallet_name(user, user.payment_address, view_key)
-        backend = self._backend_for_wallet_name(wallet_name)
-        self._ensure_wallet_open(
-            backend=backend,
-            wallet_name=wallet_name,
-            payment_address=user.payment_address,
-            view_key=view_key,
-        )
-        self._ensure_daemon(backend)
-        try:
-            index_response = backend.client.raw_request(
-                "get_address_index",
-                {"address": address},
-            )
-        except (RPCError, RequestException) as exc:
-            self._raise_wallet_rpc_error(exc)
-        index = index_response.get("index") if isinstance(index_response, dict) else None
-        major = index.get("major") if isinstance(index, dict) else None
-        minor = index.get("minor") if isinstance(index, dict) else None
-        if major is None or minor is None:
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail="Monero wallet RPC did not return an address index",
-            )
-        try:
-            transfers = backend.client.raw_request(
-                "get_transfers",
-                {
-                    "in": True,
-                    "pool": True,
-                    "account_index": major,
-                    "subaddr_indices": [minor],
-                },
-            )
-        except (RPCError, RequestException) as exc:
-            self._raise_wallet_rpc_error(exc)
-        incoming = transfers.get("in", []) if isinstance(transfers, dict) else []
-        pool = transfers.get("pool", []) if isinstance(transfers, dict) else []
+        transfers = self._fetch_transfers(user, address, address_index)
         total_atomic = 0
         max_confirmations = 0
-        seen_txids: set[str] = set()
-        for item in [*incoming, *pool]:
-            if not isinstance(item, dict):
-                continue
-            txid = item.get("txid")
-            if isinstance(txid, str):
-                if txid in seen_txids:
-                    continue
-                seen_txids.add(txid)
+        for item in transfers.values():
             total_atomic += int(item.get("amount", 0) or 0)
             confirmations = int(item.get("confirmations", 0) or 0)
             if confirmations > max_confirmations:
@@ -236,17 +241,126 @@ class MoneroWalletService:
         self,
         user: User,
         address: str,
+        address_index: int | None = None,
     ) -> list[TransferDetail]:
+        return self._transfer_details(self._fetch_transfers(user, address, address_index))
+
+    def get_transfers_by_address(
+        self,
+        user: User,
+        addresses: dict[str, int | None],
+    ) -> dict[str, list[TransferDetail]]:
+        return {
+            address: self._transfer_details(transfers)
+            for address, transfers in self._fetch_transfers_by_address(user, addresses).items()
+        }
+
+    @staticmethod
+    def _transfer_details(transfers: dict[str, dict]) -> list[TransferDetail]:
+        details: list[TransferDetail] = []
+        for txid, item in transfers.items():
+            timestamp = item.get("timestamp")
+            address_value = item.get("address")
+            details.append(
+                TransferDetail(
+                    txid=txid,
+                    amount_atomic=int(item.get("amount", 0) or 0),
+                    confirmations=int(item.get("confirmations", 0) or 0),
+                    timestamp=int(timestamp) if isinstance(timestamp, (int, float)) else None,
+                    address=address_value if isinstance(address_value, str) else None,
+                )
+            )
+        return details
+
+    def _fetch_transfers(
+        self,
+        user: User,
+        address: str,
+        address_index: int | None,
+    ) -> dict[str, dict]:
+        return self._fetch_transfers_by_address(user, {address: address_index})[address]
+
+    def _fetch_transfers_by_address(
+        self,
+        user: User,
+        addresses: dict[str, int | None],
+    ) -> dict[str, dict[str, dict]]:
         view_key = decrypt_secret(user.view_key_encrypted)
         wallet_name = self._wallet_name(user, user.payment_address, view_key)
         backend = self._backend_for_wallet_name(wallet_name)
-        self._ensure_wallet_open(
-            backend=backend,
-            wallet_name=wallet_name,
-            payment_address=user.payment_address,
-            view_key=view_key,
-        )
-        self._ensure_daemon(backend)
+        # A wallet-rpc process has one open wallet, so callers take turns per backend.
+        with backend.lock:
+            self._ensure_wallet_open(
+                backend=backend,
+                wallet_name=wallet_name,
+                payment_address=user.payment_address,
+                view_key=view_key,
+            )
+            self._ensure_daemon(backend)
+            return self._get_transfers(backend, wallet_name, addresses)
+
+    def _get_transfers(
+        self,
+        backend: WalletBackend,
+        wallet_name: str,
+        addresses: dict[str, int | None],
+    ) -> dict[str, dict[str, dict]]:
+        targets: dict[tuple[int, int], list[str]] = {}
+        for address, address_index in addresses.items():
+            if address_index is not None:
+                # Invoice subaddresses are always allocated in account 0.
+                index = (0, address_index)
+            else:
+                index = self._address_index(backend, wallet_name, address)
+            targets.setdefault(index, []).append(address)
+        minors_by_account: dict[int, list[int]] = {}
+        for major, minor in targets:
+            minors_by_account.setdefault(major, []).append(minor)
+        unique: dict[str, dict[str, dict]] = {address: {} for address in addresses}
+        # One get_transfers call per account covers every requested subaddress in it;
+        # very large sets are split so a single request stays bounded.
+        for major, all_minors in minors_by_account.items():
+            for start in range(0, len(all_minors), MONERO_WALLET_RPC_BATCH_SIZE):
+                minors = all_minors[start : start + MONERO_WALLET_RPC_BATCH_SIZE]
+                try:
+                    transfers = backend.client.raw_request(
+                        "get_transfers",
+                        {
+                            "in": True,
+                            "pool": True,
+                            "account_index": major,
+                            "subaddr_indices": minors,
+                        },
+                    )
+                except (RPCError, RequestException) as exc:
+                    backend.daemon_set_for = None
+                    self._raise_wallet_rpc_error(exc)
+                if not isinstance(transfers, dict):
+                    continue
+                # Keyed by txid so a transfer listed in both "in" and "pool" is counted once.
+                for item in chain(transfers.get("in") or (), transfers.get("pool") or ()):
+                    if not isinstance(item, dict):
+                        continue
+                    txid = item.get("txid")
+                    if not isinstance(txid, str) or not txid:
+                        continue
+                    subaddr_index = item.get("subaddr_index")
+                    minor = subaddr_index.get("minor") if isinstance(subaddr_index, dict) else None
+                    if minor is None and len(minors) == 1:
+                        minor = minors[0]
+                    for address in targets.get((major, minor), ()):
+                        unique[address].setdefault(txid, item)
+        return unique
+
+    def _address_index(
+        self,
+        backend: WalletBackend,
+        wallet_name: str,
+        address: str,
+    ) -> tuple[int, int]:
+        cached = backend.address_indices.get((wallet_name, address))
+        if cached is not None:
+            return cached
         try:
             index_response = backend.client.raw_request(
                 "get_address_index",
@@ -262,45 +376,10 @@ class MoneroWalletService:
                 status_code=status.HTTP_502_BAD_GATEWAY,
                 detail="Monero wallet RPC did not return an address index",
             )
-        try:
-            transfers = backend.client.raw_request(
-                "get_transfers",
-                {
-                    "in": True,
-                    "pool": True,
-                    "account_index": major,
-                    "subaddr_indices": [minor],
-                },
-            )
-        except (RPCError, RequestException) as exc:
-            self._raise_wallet_rpc_error(exc)
-        incoming = transfers.get("in", []) if isinstance(transfers, dict) else []
-        pool = transfers.get("pool", []) if isinstance(transfers, dict) else []
-        details: list[TransferDetail] = []
-        seen_txids: set[str] = set()
-        for item in [*incoming, *pool]:
-            if not isinstance(item, dict):
-                continue
-            txid = item.get("txid")
-            if not isinstance(txid, str) or not txid:
-                continue
-            if txid in seen_txids:
-                continue
-            seen_txids.add(txid)
-            amount_atomic = int(item.get("amount", 0) or 0)
-            confirmations = int(item.get("confirmations", 0) or 0)
-            timestamp = item.get("timestamp")
-            timestamp_value = int(timestamp) if isinstance(timestamp, (int, float)) else None
-            details.append(
-                TransferDetail(
-                    txid=txid,
-                    amount_atomic=amount_atomic,
-                    confirmations=confirmations,
-                    timestamp=timestamp_value,
-                    address=item.get("address") if isinstance(item.get("address"), str) else None,
-                )
-            )
-        return details
+        if len(backend.address_indices) >= _ADDRESS_INDEX_CACHE_MAX:
+            backend.address_indices.clear()
+        backend.address_indices[(wallet_name, address)] = (major, minor)
+        return major, minor
 
     @staticmethod
     def _rpc_error_message(exc: RPCError) -> str:
@@ -312,13 +391,50 @@ class MoneroWalletService:
                 message = f"{message} {detail}"
         return message
 
+    def get_chain_state(self) -> tuple[int, str, int] | None:
+        if not self._daemon_url:
+            return None
+        url = self._daemon_url.rstrip("/")
+        payload = {"jsonrpc": "2.0", "id": "0", "method": "get_info"}
+        try:
+            response = http_session.post(f"{url}/json_rpc", json=payload, timeout=5)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+        result = data.get("result") if isinstance(data, dict) else None
+        if not isinstance(result, dict):
+            return None
+        height = result.get("height")
+        top_block_hash = result.get("top_block_hash")
+        tx_pool_size = result.get("tx_pool_size")
+        if not (
+            isinstance(height, int)
+            and isinstance(top_block_hash, str)
+            and isinstance(tx_pool_size, int)
+        ):
+            return None
+        return height, top_block_hash, tx_pool_size
+
     def _daemon_height(self) -> int | None:
         if not self._daemon_url:
             return None
+        # Restore height only needs a recent lower bound, so one lookup serves every
+        # wallet generated within the TTL; the lock makes concurrent callers share it.
+        with self._daemon_height_lock:
+            cached = self._daemon_height_cache
+            if cached is not None and time.monotonic() - cached[1] < _DAEMON_HEIGHT_TTL_SECONDS:
+                return cached[0]
+            height = self._fetch_daemon_height()
+            if height is not None:
+                self._daemon_height_cache = (height, time.monotonic())
+            return height
+
+    def _fetch_daemon_height(self) -> int | None:
         url = self._daemon_url.rstrip("/")
         payload = {"jsonrpc": "2.0", "id": "0", "method": "get_height"}
         try:
-            response = requests.post(f"{url}/json_rpc", json=payload, timeout=5)
+            response = http_session.post(f"{url}/json_rpc", json=payload, timeout=5)
             response.raise_for_status()
             data = response.json()
             result = data.get("result") if isinstance(data, dict) else None
@@ -329,7 +445,7 @@ class MoneroWalletService:
             pass
 
         try:
-            response = requests.get(f"{url}/get_height", timeout=5)
+            response = http_session.get(f"{url}/get_height", timeout=5)
             response.raise_for_status()
             data = response.json()
         except (requests.RequestException, ValueError):
@@ -339,15 +455,10 @@ class MoneroWalletService:
 
     @staticmethod
     def _wallet_name(user: User, payment_address: str, view_key: str) -> str:
-        fingerprint = hashlib.sha256(
-            f"{payment_address}:{view_key}".encode("utf-8")
-        ).hexdigest()[:12]
-        return f"user-{user.id}-{fingerprint}"
+        return _wallet_name(str(user.id), payment_address, view_key)
 
     def _backend_for_wallet_name(self, wallet_name: str) -> WalletBackend:
-        digest = hashlib.sha256(wallet_name.encode("utf-8")).hexdigest()
-        index = int(digest, 16) % len(self._backends)
-        return self._backends[index]
+        return self._backends[_backend_slot(wallet_name, len(self._backends))]
 
     def _ensure_wallet_open(
         self,
@@ -429,13 +540,17 @@ class MoneroWalletService:
     def _ensure_daemon(self, backend: WalletBackend) -> None:
         if not self._daemon_address:
             return
+        if backend.current_wallet is not None and backend.daemon_set_for == backend.current_wallet:
+            return
         try:
             backend.client.raw_request(
                 "set_daemon",
                 {"address": self._daemon_address},
             )
         except (RPCError, RequestException) as exc:
+            backend.daemon_set_for = None
             self._raise_wallet_rpc_error(exc)
+        backend.daemon_set_for = backend.current_wallet
 
     @staticmethod
     def _raise_wallet_rpc_error(exc: Exception) -> None:
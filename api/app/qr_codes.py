@@ -2,19 +2,39 @@ from __future__ import annotations
 
 import base64
 import os
+import stat
 import tempfile
+import threading
+import time
 from dataclasses import dataclass
+from decimal import Decimal
+from functools import lru_cache
+from io import BytesIO
 from typing import Any
+from urllib.parse import quote, urlencode
 
 from fastapi import HTTPException, status
-import qrcode
-from qrcode.constants import ERROR_CORRECT_H
+import segno
 from PIL import Image
 
 from .formatting import format_xmr_amount
 from .models import Invoice
 
 
+# zlib's default effort: level 9 / optimize=True cost ~40% more time for ~5% smaller files.
+_PNG_COMPRESS_LEVEL = 6
+
+_prepared_dirs_lock = threading.Lock()
+_prepared_dirs: set[str] = set()
+
+# Status pages poll every few seconds; a QR file never changes once written, so a
+# recent positive check lets those polls skip the stat entirely.
+_RENDERED_TTL_SECONDS = 300
+_RENDERED_MAX = 10_000
+_rendered_lock = threading.Lock()
+_rendered: dict[str, float] = {}
+
+
 @dataclass(frozen=True)
 class QrSettings:
     logo: str  # "monero" | "none" | "custom"
@@ -36,62 +56,115 @@ def ensure_invoice_qr_png(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="QR storage is not configured",
         )
-    os.makedirs(storage_dir, exist_ok=True)
-    try:
-        os.chmod(storage_dir, 0o755)
-    except Exception:
-        pass
     filename = f"{invoice.id}.png"
     path = os.path.join(storage_dir, filename)
-    if os.path.exists(path):
-        try:
-            os.chmod(path, 0o644)
-        except Exception:
-            pass
+    now = time.monotonic()
+    with _rendered_lock:
+        checked_until = _rendered.get(path)
+    if checked_until is not None and checked_until > now:
+        return path
+    _prepare_storage_dir(storage_dir)
+    try:
+        existing = os.stat(path)
+    except FileNotFoundError:
+        existing = None
+    # An empty file can only be left behind by a crash mid-write, so render it again.
+    if existing is not None and existing.st_size > 0:
+        if stat.S_IMODE(existing.st_mode) != 0o644:
+            try:
+                os.chmod(path, 0o644)
+            except Exception:
+                pass
+        _remember_rendered(path, now)
         return path
     png_bytes = build_invoice_qr_png_bytes(invoice=invoice, settings=settings)
     _atomic_write(path, png_bytes)
-    try:
-        os.chmod(path, 0o644)
-    except Exception:
-        pass
+    _remember_rendered(path, now)
     return path
 
 
+def _remember_rendered(path: str, now: float) -> None:
+    with _rendered_lock:
+        _rendered.pop(path, None)
+        if len(_rendered) >= _RENDERED_MAX:
+            _rendered.pop(next(iter(_rendered)))
+        _rendered[path] = now + _RENDERED_TTL_SECONDS
+
+
+def _prepare_storage_dir(storage_dir: str) -> None:
+    if storage_dir in _prepared_dirs:
+        return
+    with _prepared_dirs_lock:
+        if storage_dir in _prepared_dirs:
+            return
+        os.makedirs(storage_dir, exist_ok=True)
+        try:
+            os.chmod(storage_dir, 0o755)
+        except Exception:
+            pass
+        _prepared_dirs.add(storage_dir)
+
+
 def build_invoice_qr_png_bytes(*, invoice: Invoice, settings: QrSettings) -> bytes:
-    uri = build_monero_uri(invoice)
-    qr = qrcode.QRCode(
-        error_correction=ERROR_CORRECT_H,
-        border=2,
-        box_size=10,
+    return _render_qr_png(build_monero_uri(invoice), settings)
+
+
+# The URI already carries address, amount and description, so it plus the settings
+# fully determines the image.
+@lru_cache(maxsize=256)
+def _render_qr_png(uri: str, settings: QrSettings) -> bytes:
+    qr_png = BytesIO()
+    segno.make(uri, error="h", micro=False).save(
+        qr_png, kind="png", scale=10, border=2, compresslevel=_PNG_COMPRESS_LEVEL
     )
-    qr.add_data(uri)
-    qr.make(fit=True)
-    image = qr.make_image(fill_color="black", back_color="white").convert("RGBA")
+    if not (settings.logo == "custom" and settings.logo_data_url):
+        return qr_png.getvalue()
 
-    if settings.logo == "custom" and settings.logo_data_url:
-        logo = _load_logo_from_data_url(settings.logo_data_url)
-        image = _overlay_logo(image, logo)
+    # Only the logo overlay needs a PIL image; plain codes are written by segno directly.
+    qr_png.seek(0)
+    image = Image.open(qr_png).convert("RGBA")
+    image = _overlay_logo(image, settings.logo_data_url)
 
-    out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
-    image.save(out, format="PNG", optimize=True)
-    out.seek(0)
-    return out.read()
+    out = BytesIO()
+    image.save(out, format="PNG", compress_level=_PNG_COMPRESS_LEVEL)
+    return out.getvalue()
 
 
 def build_monero_uri(invoice: Invoice) -> str:
-    amount = format_xmr_amount(invoice.amount_xmr)
-    params: dict[str, str] = {"tx_amount": amount}
+    recipient_name = None
+    description = None
     metadata = invoice.metadata_json or {}
     if isinstance(metadata, dict):
         recipient_name = metadata.get("recipient_name")
         description = metadata.get("description")
-        if isinstance(recipient_name, str) and recipient_name.strip():
-            params["recipient_name"] = recipient_name.strip()
-        if isinstance(description, str) and description.strip():
-            params["tx_description"] = description.strip()
-    query = "&".join(f"{_url_escape(k)}={_url_escape(v)}" for k, v in params.items())
-    return f"monero:{invoice.address}?{query}"
+    return _monero_uri(
+        invoice.address,
+        invoice.amount_xmr,
+        recipient_name if isinstance(recipient_name, str) else None,
+        description if isinstance(description, str) else None,
+    )
+
+
+@lru_cache(maxsize=8192)
+def _monero_uri(
+    address: str,
+    amount_xmr: Decimal,
+    recipient_name: str | None,
+    description: str | None,
+) -> str:
+    amount = format_xmr_amount(amount_xmr)
+    recipient_name = recipient_name.strip() if recipient_name else ""
+    description = description.strip() if description else ""
+    if not recipient_name and not description:
+        # Formatted amounts are digits and "." only, so they need no escaping.
+        return f"monero:{address}?tx_amount={amount}"
+    params: dict[str, str] = {"tx_amount": amount}
+    if recipient_name:
+        params["recipient_name"] = recipient_name
+    if description:
+        params["tx_description"] = description
+    query = urlencode(params, quote_via=quote, safe="")
+    return f"monero:{address}?{query}"
 
 
 def resolve_qr_settings(invoice: Invoice) -> QrSettings:
@@ -111,21 +184,25 @@ def resolve_qr_settings(invoice: Invoice) -> QrSettings:
 
 
 def _atomic_write(path: str, data: bytes) -> None:
+    # QR images can always be re-rendered, so the write skips fsync; a torn write
+    # leaves at worst an empty file, which ensure_invoice_qr_png treats as missing.
     directory = os.path.dirname(path) or "."
-    os.makedirs(directory, exist_ok=True)
-    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
     try:
         with os.fdopen(fd, "wb") as tmp_file:
+            os.fchmod(tmp_file.fileno(), 0o644)
             tmp_file.write(data)
-            tmp_file.flush()
-            os.fsync(tmp_file.fileno())
         os.replace(tmp_path, path)
-    finally:
+    except BaseException:
         try:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            os.remove(tmp_path)
         except Exception:
             pass
+        raise
 
 
 def _load_logo_from_data_url(data_url: str) -> Image.Image:
@@ -150,8 +227,6 @@ def _load_logo_from_data_url(data_url: str) -> Image.Image:
             detail="QR logo could not be decoded",
         ) from exc
     try:
-        from io import BytesIO
-
         logo = Image.open(BytesIO(raw)).convert("RGBA")
     except Exception as exc:
         raise HTTPException(
@@ -161,14 +236,22 @@ def _load_logo_from_data_url(data_url: str) -> Image.Image:
     return logo
 
 
-def _overlay_logo(qr_image: Image.Image, logo: Image.Image) -> Image.Image:
+# A merchant's default logo is shared by all of their invoices, so decode and
+# downscale it once per size rather than on every render. Callers must not mutate it.
+@lru_cache(maxsize=64)
+def _sized_logo(data_url: str, target_logo_size: int) -> Image.Image:
+    logo = _load_logo_from_data_url(data_url)
+    logo.thumbnail((target_logo_size, target_logo_size), Image.LANCZOS)
+    return logo
+
+
+def _overlay_logo(qr_image: Image.Image, logo_data_url: str) -> Image.Image:
     # Center a small logo with a white backing.
     size = min(qr_image.size)
     target_logo_size = int(size * 0.22)
     if target_logo_size < 24:
         return qr_image
-    logo = logo.copy()
-    logo.thumbnail((target_logo_size, target_logo_size), Image.LANCZOS)
+    logo = _sized_logo(logo_data_url, target_logo_size)
 
     overlay = Image.new("RGBA", qr_image.size, (255, 255, 255, 0))
     box_size = int(size * 0.28)
@@ -180,9 +263,3 @@ def _overlay_logo(qr_image: Image.Image, logo: Image.Image) -> Image.Image:
     overlay.paste(logo, logo_offset, mask=logo)
 
     return Image.alpha_composite(qr_image, overlay)
-
-
-def _url_escape(value: str) -> str:
-    from urllib.parse import quote
-
-    return quote(value, safe="")
@@ -7,13 +7,14 @@ import threading
 import time
 from typing import Any
 
-import requests
-
 from .config import COINGECKO_API_KEY
+from .http_client import http_session
 
 COINGECKO_URL = "https://api.coingecko.com/api/v3/simple/price"
 COINGECKO_SOURCE = "coingecko"
 RATE_TTL_SECONDS = 60
+REFRESH_WAIT_SECONDS = 6
+_ATOMIC_PER_XMR = 10**12
 
 
 @dataclass(frozen=True)
@@ -22,30 +23,53 @@ class QuoteResult:
     currency: str
     source: str
     quoted_at: datetime
+    # rate as an exact (numerator, denominator) pair, parsed once per refresh.
+    rate_ratio: tuple[int, int]
 
 
 _cache_lock = threading.Lock()
-_cached_quote: QuoteResult | None = None
-_cached_at: float | None = None
+_cached_quotes: dict[str, tuple[QuoteResult, float]] = {}
+_refreshing: dict[str, threading.Event] = {}
 
 
 def get_xmr_rate(currency: str) -> QuoteResult:
-    global _cached_quote, _cached_at
     normalized_currency = currency.strip().lower()
     if not COINGECKO_API_KEY:
         raise RuntimeError("CoinGecko API key is not configured")
 
-    with _cache_lock:
-        if _cached_quote and _cached_at:
-            if time.monotonic() - _cached_at < RATE_TTL_SECONDS:
-                return _cached_quote
+    # Only one thread per currency refreshes an expired quote; the rest wait for it.
+    while True:
+        with _cache_lock:
+            cached = _cached_quotes.get(normalized_currency)
+            if cached is not None:
+                quote, cached_at = cached
+                if time.monotonic() - cached_at < RATE_TTL_SECONDS:
+                    return quote
+            refresh = _refreshing.get(normalized_currency)
+            if refresh is None:
+                refresh = threading.Event()
+                _refreshing[normalized_currency] = refresh
+                break
+        refresh.wait(timeout=REFRESH_WAIT_SECONDS)
+
+    try:
+        quote = _fetch_quote(normalized_currency)
+        with _cache_lock:
+            _cached_quotes[normalized_currency] = (quote, time.monotonic())
+        return quote
+    finally:
+        with _cache_lock:
+            _refreshing.pop(normalized_currency, None)
+        refresh.set()
+
 
+def _fetch_quote(normalized_currency: str) -> QuoteResult:
     params = {
         "vs_currencies": normalized_currency,
         "ids": "monero",
         "x_cg_demo_api_key": COINGECKO_API_KEY,
     }
-    response = requests.get(COINGECKO_URL, params=params, timeout=5)
+    response = http_session.get(COINGECKO_URL, params=params, timeout=5)
     response.raise_for_status()
     data: dict[str, Any] = response.json()
     rate_value = (
@@ -56,13 +80,21 @@ def get_xmr_rate(currency: str) -> QuoteResult:
     if rate_value is None:
         raise ValueError("Unsupported fiat currency at this time")
     rate = Decimal(str(rate_value))
-    quote = QuoteResult(
+    return QuoteResult(
         rate=rate,
         currency=normalized_currency.upper(),
         source=COINGECKO_SOURCE,
         quoted_at=datetime.now(timezone.utc),
+        rate_ratio=rate.as_integer_ratio(),
+    )
+
+
+def fiat_to_xmr(amount: Decimal, quote: QuoteResult) -> Decimal:
+    # Exact integer division, truncated to whole atomic units (same as ROUND_DOWN for the
+    # positive amounts callers pass), without going through Decimal's context precision.
+    amount_numerator, amount_denominator = Decimal(amount).as_integer_ratio()
+    rate_numerator, rate_denominator = quote.rate_ratio
+    atomic = (amount_numerator * _ATOMIC_PER_XMR * rate_denominator) // (
+        amount_denominator * rate_numerator
     )
-    with _cache_lock:
-        _cached_quote = quote
-        _cached_at = time.monotonic()
-    return quote
+    return Decimal(atomic).scaleb(-12)
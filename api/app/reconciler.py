@@ -1,22 +1,45 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import time
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_DOWN
+from functools import lru_cache
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, bindparam, delete, insert, or_
 from sqlalchemy.orm import Session
 
-from .btcpay_webhooks import dispatch_btcpay_webhooks
-from .config import INVOICE_RECONCILE_INTERVAL_SECONDS, LATE_PAYMENT_LOOKBACK_HOURS
+from .config import (
+    INVOICE_RECONCILE_INTERVAL_SECONDS,
+    LATE_PAYMENT_LOOKBACK_HOURS,
+    RECONCILE_WORKERS,
+)
 from .db import SessionLocal
 from .models import Invoice, InvoiceTransfer, User
 from .monero_service import MoneroWalletService, TransferDetail
-from .webhooks import dispatch_webhooks
+from .webhook_outbox import build_outbox_event, enqueue_webhook_events, start_outbox_worker
 
 logger = logging.getLogger(__name__)
 
+_ATOMIC_PER_XMR = Decimal(10**12)
+_FULL_PASS_EVERY_CYCLES = 10
+_USER_PAGE_SIZE = 200
+_MAX_DORMANT_BACKOFF_SECONDS = min(8 * INVOICE_RECONCILE_INTERVAL_SECONDS, 1800)
+# Built once with bound parameters so each tick reuses the expression and its cached SQL.
+_OPEN_INVOICES = or_(
+    Invoice.status.in_(["pending", "payment_detected"]),
+    and_(
+        Invoice.status == "expired",
+        Invoice.expires_at.is_not(None),
+        Invoice.expires_at >= bindparam("late_cutoff"),
+    ),
+)
+
+# Users whose open invoices have all expired are only watched for late payments, so
+# they are polled less often while nothing changes: user_id -> (next poll, idle passes).
+_dormant_backoff: dict[object, tuple[float, int]] = {}
+
 
 def main() -> None:
     level_name = "INFO"
@@ -27,178 +50,321 @@ def main() -> None:
     level = getattr(logging, level_name.upper(), logging.INFO)
     logging.basicConfig(level=level)
     service = MoneroWalletService()
+    service.warm_up()
+    start_outbox_worker()
+    chain_state = None
+    unchanged_cycles = 0
+    last_pass_started_at: datetime | None = None
     while True:
         try:
-            _reconcile_invoices(service)
+            state = service.get_chain_state()
+            if state is None or state != chain_state:
+                chain_state = state
+                unchanged_cycles = 0
+            else:
+                unchanged_cycles += 1
+            if _can_skip_cycle(unchanged_cycles, last_pass_started_at):
+                logger.debug("Chain state unchanged, skipping reconcile")
+            else:
+                started_at = datetime.now(timezone.utc)
+                _reconcile_invoices(service)
+                last_pass_started_at = started_at
         except Exception as exc:
+            unchanged_cycles = 0
             logger.exception("Invoice reconcile failed: %s", exc)
         time.sleep(INVOICE_RECONCILE_INTERVAL_SECONDS)
 
 
+def _can_skip_cycle(unchanged_cycles: int, last_pass_started_at: datetime | None) -> bool:
+    # Wallets refresh on their own timer, so one more pass after the daemon moves lets
+    # them catch up; the periodic full pass covers pool transactions that were replaced
+    # without changing the pool size.
+    if last_pass_started_at is None or unchanged_cycles < 2:
+        return False
+    if unchanged_cycles % _FULL_PASS_EVERY_CYCLES == 0:
+        return False
+    db: Session = SessionLocal()
+    try:
+        expiry_due = (
+            db.query(Invoice.id)
+            .filter(
+                Invoice.status == "pending",
+                Invoice.expires_at > last_pass_started_at,
+                Invoice.expires_at <= datetime.now(timezone.utc),
+            )
+            .first()
+        )
+    finally:
+        db.close()
+    return expiry_due is None
+
+
 def _reconcile_invoices(service: MoneroWalletService) -> None:
     db: Session = SessionLocal()
     try:
         now = datetime.now(timezone.utc)
         late_cutoff = now - timedelta(hours=max(0, LATE_PAYMENT_LOOKBACK_HOURS))
-        invoices = (
-            db.query(Invoice)
-            .filter(
-                or_(
-                    Invoice.status.in_(["pending", "payment_detected"]),
-                    and_(
-                        Invoice.status == "expired",
-                        Invoice.expires_at.is_not(None),
-                        Invoice.expires_at >= late_cutoff,
-                    ),
-                )
-            )
-            .order_by(Invoice.created_at.asc())
+        user_ids = [
+            user_id
+            for (user_id,) in db.query(Invoice.user_id)
+            .filter(_OPEN_INVOICES, Invoice.user_id.is_not(None))
+            .distinct()
+            .params(late_cutoff=late_cutoff)
             .all()
+        ]
+        logger.debug("Reconciling invoices across %d users", len(user_ids))
+        for user_id in _dormant_backoff.keys() - set(user_ids):
+            del _dormant_backoff[user_id]
+        # Users are handled a page at a time so only one page of invoices is held in memory.
+        for start in range(0, len(user_ids), _USER_PAGE_SIZE):
+            page = user_ids[start : start + _USER_PAGE_SIZE]
+            invoices = (
+                db.query(Invoice)
+                .filter(_OPEN_INVOICES, Invoice.user_id.in_(bindparam("user_ids", expanding=True)))
+                .order_by(Invoice.created_at.asc())
+                .params(late_cutoff=late_cutoff, user_ids=page)
+                .all()
+            )
+            user_groups: dict[object, list[Invoice]] = {}
+            for invoice in invoices:
+                user_groups.setdefault(invoice.user_id, []).append(invoice)
+            users = {user.id: user for user in db.query(User).filter(User.id.in_(page)).all()}
+            # Workers attach the rows to their own sessions, so release them from this one.
+            db.close()
+            work: list[tuple[User, list[Invoice]]] = []
+            # Kept apart from the rows, which a failed user's rollback expires.
+            work_states: list[tuple[object, bool]] = []
+            for user_id, user_invoices in user_groups.items():
+                user = users.get(user_id)
+                if user is None:
+                    logger.debug(
+                        "Skipping invoices with missing user",
+                        extra={"user_id": str(user_id)},
+                    )
+                    continue
+                if not user.payment_address or not user.view_key_encrypted:
+                    logger.debug(
+                        "Skipping invoices without payment address",
+                        extra={"user_id": str(user.id)},
+                    )
+                    continue
+                dormant = all(invoice.status == "expired" for invoice in user_invoices)
+                if not dormant:
+                    _dormant_backoff.pop(user_id, None)
+                else:
+                    backoff = _dormant_backoff.get(user_id)
+                    if backoff is not None and time.monotonic() < backoff[0]:
+                        continue
+                work.append((user, user_invoices))
+                work_states.append((user_id, dormant))
+            if len(work) > 1 and RECONCILE_WORKERS > 1:
+                with ThreadPoolExecutor(
+                    max_workers=min(len(work), RECONCILE_WORKERS),
+                    thread_name_prefix="reconcile",
+                ) as executor:
+                    results = list(
+                        executor.map(lambda item: _reconcile_user(service, *item), work)
+                    )
+            else:
+                results = [
+                    _reconcile_user(service, user, user_invoices) for user, user_invoices in work
+                ]
+            for (user_id, dormant), changed in zip(work_states, results):
+                if dormant and not changed:
+                    idle_passes = _dormant_backoff.get(user_id, (0.0, 0))[1] + 1
+                    delay = min(
+                        INVOICE_RECONCILE_INTERVAL_SECONDS * 2**idle_passes,
+                        _MAX_DORMANT_BACKOFF_SECONDS,
+                    )
+                    _dormant_backoff[user_id] = (time.monotonic() + delay, idle_passes)
+                else:
+                    _dormant_backoff.pop(user_id, None)
+    finally:
+        db.close()
+
+
+def _reconcile_user(
+    service: MoneroWalletService,
+    user: User,
+    user_invoices: list[Invoice],
+) -> bool:
+    user_id = str(user.id)
+    # The rows are loaded up front; expiring them on commit would turn the batched
+    # loads back into one refresh SELECT per row.
+    db: Session = SessionLocal(expire_on_commit=False)
+    try:
+        db.add(user)
+        db.add_all(user_invoices)
+        return _reconcile_user_invoices(db, service, user, user_invoices)
+    except Exception as exc:
+        # One failing account must not abandon the rest of the pass. Reporting a change
+        # keeps the user out of the dormant backoff, so the next pass retries promptly.
+        db.rollback()
+        logger.exception(
+            "User reconcile failed: %s",
+            exc,
+            extra={"user_id": user_id},
         )
-        user_groups: dict[object, list[Invoice]] = {}
-        for invoice in invoices:
-            if invoice.user_id is None:
-                logger.debug(
-                    "Skipping invoice without user",
-                    extra={"invoice_id": str(invoice.id)},
-                )
+        return True
+    finally:
+        db.close()
+
+
+def _reconcile_user_invoices(
+    db: Session,
+    service: MoneroWalletService,
+    user: User,
+    user_invoices: list[Invoice],
+) -> bool:
+    # Changes for the whole user are flushed together, so the unit of work sends
+    # the invoice UPDATEs as one batch; webhook events are queued in the same commit.
+    user_changed = False
+    pending_events: list[dict[str, object]] = []
+    # Transition timestamps are recorded at pass granularity for the whole user.
+    now = datetime.now(timezone.utc)
+    fresh_invoices: list[Invoice] = []
+    for invoice in user_invoices:
+        if (
+            invoice.status == "payment_detected"
+            and (invoice.confirmations or 0) >= invoice.confirmation_target
+        ):
+            # The stored confirmations already meet the target, so only the status
+            # transition is outstanding and the wallet does not need to be asked.
+            pending_events.append(_mark_confirmed(invoice, user, now))
+        else:
+            fresh_invoices.append(invoice)
+    transfers_by_address: dict[str, list[TransferDetail]] = {}
+    if fresh_invoices:
+        try:
+            transfers_by_address = service.get_transfers_by_address(
+                user=user,
+                addresses={
+                    invoice.address: invoice.subaddress_index for invoice in fresh_invoices
+                },
+            )
+        except Exception as exc:
+            logger.warning(
+                "Skipping user reconcile due to wallet RPC error",
+                extra={"user_id": str(user.id)},
+            )
+            logger.debug("Wallet RPC error: %s", exc)
+            fresh_invoices = []
+    stored_transfers: dict[object, list[InvoiceTransfer]] = {}
+    if fresh_invoices:
+        for stored in (
+            db.query(InvoiceTransfer)
+            .filter(InvoiceTransfer.invoice_id.in_([invoice.id for invoice in fresh_invoices]))
+            .all()
+        ):
+            stored_transfers.setdefault(stored.invoice_id, []).append(stored)
+    for invoice in fresh_invoices:
+        transfers = transfers_by_address.get(invoice.address, [])
+        total_atomic = 0
+        max_confirmations = 0
+        for transfer in transfers:
+            if transfer.amount_atomic <= 0:
                 continue
-            user_groups.setdefault(invoice.user_id, []).append(invoice)
+            total_atomic += transfer.amount_atomic
+            if transfer.confirmations > max_confirmations:
+                max_confirmations = transfer.confirmations
         logger.debug(
-            "Reconciling %d invoices across %d users",
-            len(invoices),
-            len(user_groups),
+            "Invoice totals",
+            extra={
+                "invoice_id": str(invoice.id),
+                "received_atomic": total_atomic,
+                "confirmations": max_confirmations,
+            },
+        )
+        previous_confirmations = invoice.confirmations or 0
+        total_changed = invoice.total_paid_atomic != total_atomic
+        confirmations_changed = previous_confirmations != max_confirmations
+        transfers_changed = _sync_invoice_transfers(
+            db,
+            invoice=invoice,
+            transfers=transfers,
+            existing=stored_transfers.get(invoice.id, []),
         )
-        for user_id, user_invoices in user_groups.items():
-            user = db.query(User).filter(User.id == user_id).first()
-            if user is None:
-                logger.debug(
-                    "Skipping invoices with missing user",
-                    extra={"user_id": str(user_id)},
+        if total_changed or confirmations_changed or transfers_changed:
+            user_changed = True
+        if confirmations_changed:
+            invoice.confirmations = max_confirmations
+        if total_changed:
+            invoice.total_paid_atomic = total_atomic
+        required_atomic = _xmr_to_atomic(invoice.amount_xmr)
+        is_paid = total_atomic >= required_atomic
+
+        expires_at = invoice.expires_at
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        is_after_expiry = bool(expires_at and now >= expires_at)
+
+        if not is_paid:
+            logger.debug(
+                "Payment not yet detected",
+                extra={
+                    "invoice_id": str(invoice.id),
+                    "required_atomic": required_atomic,
+                    "received_atomic": total_atomic,
+                },
+            )
+            if invoice.status == "pending" and is_after_expiry:
+                logger.info(
+                    "Invoice expired",
+                    extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
                 )
-                continue
-            if not user.payment_address or not user.view_key_encrypted:
-                logger.debug(
-                    "Skipping invoices without payment address",
-                    extra={"user_id": str(user.id)},
+                invoice.status = "expired"
+                pending_events.append(
+                    build_outbox_event(user.id, invoice, "invoice.expired", ("InvoiceExpired",))
                 )
-                continue
-            for invoice in user_invoices:
-                try:
-                    transfers = service.get_transfers_for_address(
-                        user=user,
-                        address=invoice.address,
-                    )
-                except Exception as exc:
-                    logger.warning(
-                        "Skipping invoice reconcile due to wallet RPC error",
-                        extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
-                    )
-                    logger.debug("Wallet RPC error: %s", exc)
-                    continue
-                total_atomic = 0
-                max_confirmations = 0
-                for transfer in transfers:
-                    if transfer.amount_atomic <= 0:
-                        continue
-                    total_atomic += transfer.amount_atomic
-                    if transfer.confirmations > max_confirmations:
-                        max_confirmations = transfer.confirmations
-                logger.debug(
-                    "Invoice totals",
-                    extra={
-                        "invoice_id": str(invoice.id),
-                        "received_atomic": total_atomic,
-                        "confirmations": max_confirmations,
-                    },
+        else:
+            if invoice.status in ("pending", "expired"):
+                logger.info(
+                    "Invoice marked payment detected",
+                    extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
                 )
-                now = datetime.now(timezone.utc)
-                previous_confirmations = invoice.confirmations or 0
-                total_changed = invoice.total_paid_atomic != total_atomic
-                confirmations_changed = previous_confirmations != max_confirmations
-                transfers_changed = _sync_invoice_transfers(
-                    db,
-                    invoice=invoice,
-                    transfers=transfers,
+                previous_status = invoice.status
+                invoice.status = "payment_detected"
+                if invoice.detected_at is None:
+                    invoice.detected_at = now
+                if previous_status == "expired" or (previous_status == "pending" and is_after_expiry):
+                    invoice.paid_after_expiry = True
+                    if invoice.paid_after_expiry_at is None:
+                        invoice.paid_after_expiry_at = now
+                pending_events.append(
+                    build_outbox_event(
+                        user.id,
+                        invoice,
+                        "invoice.payment_detected",
+                        (
+                            "InvoiceReceivedPayment",
+                            "InvoicePaidInFull",
+                            "InvoiceProcessing",
+                        ),
+                    )
                 )
-                if total_changed or confirmations_changed or transfers_changed:
-                    if confirmations_changed:
-                        invoice.confirmations = max_confirmations
-                    if total_changed:
-                        invoice.total_paid_atomic = total_atomic
-                    db.add(invoice)
-                    db.commit()
-                required_atomic = _xmr_to_atomic(invoice.amount_xmr)
-                is_paid = total_atomic >= required_atomic
+            if max_confirmations >= invoice.confirmation_target and invoice.status != "confirmed":
+                pending_events.append(_mark_confirmed(invoice, user, now))
+    if user_changed or pending_events:
+        enqueue_webhook_events(db, pending_events)
+        db.commit()
+    return user_changed or bool(pending_events)
 
-                expires_at = invoice.expires_at
-                if expires_at is not None and expires_at.tzinfo is None:
-                    expires_at = expires_at.replace(tzinfo=timezone.utc)
-                is_after_expiry = bool(expires_at and now >= expires_at)
 
-                if total_atomic < required_atomic:
-                    logger.debug(
-                        "Payment not yet detected",
-                        extra={
-                            "invoice_id": str(invoice.id),
-                            "required_atomic": required_atomic,
-                            "received_atomic": total_atomic,
-                        },
-                    )
-                    if invoice.status == "pending" and is_after_expiry:
-                        logger.info(
-                            "Invoice expired",
-                            extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
-                        )
-                        invoice.status = "expired"
-                        db.add(invoice)
-                        db.commit()
-                        dispatch_webhooks(db, str(user.id), "invoice.expired", invoice)
-                        dispatch_btcpay_webhooks(
-                            db, str(user.id), "InvoiceExpired", invoice
-                        )
-                    continue
-
-                if is_paid and invoice.status in ("pending", "expired"):
-                    logger.info(
-                        "Invoice marked payment detected",
-                        extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
-                    )
-                    previous_status = invoice.status
-                    invoice.status = "payment_detected"
-                    if invoice.detected_at is None:
-                        invoice.detected_at = now
-                    if previous_status == "expired" or (previous_status == "pending" and is_after_expiry):
-                        invoice.paid_after_expiry = True
-                        if invoice.paid_after_expiry_at is None:
-                            invoice.paid_after_expiry_at = now
-                    db.add(invoice)
-                    db.commit()
-                    dispatch_webhooks(db, str(user.id), "invoice.payment_detected", invoice)
-                    dispatch_btcpay_webhooks(
-                        db, str(user.id), "InvoiceReceivedPayment", invoice
-                    )
-                    dispatch_btcpay_webhooks(db, str(user.id), "InvoicePaidInFull", invoice)
-                    dispatch_btcpay_webhooks(
-                        db, str(user.id), "InvoiceProcessing", invoice
-                    )
-                if max_confirmations >= invoice.confirmation_target and invoice.status != "confirmed":
-                    logger.info(
-                        "Invoice confirmed",
-                        extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
-                    )
-                    invoice.status = "confirmed"
-                    if invoice.confirmed_at is None:
-                        invoice.confirmed_at = now
-                    db.add(invoice)
-                    db.commit()
-                    dispatch_webhooks(db, str(user.id), "invoice.confirmed", invoice)
-                    dispatch_btcpay_webhooks(db, str(user.id), "InvoiceSettled", invoice)
-                    dispatch_btcpay_webhooks(
-                        db, str(user.id), "InvoicePaymentSettled", invoice
-                    )
-    finally:
-        db.close()
+def _mark_confirmed(
+    invoice: Invoice,
+    user: User,
+    now: datetime,
+) -> dict[str, object]:
+    logger.info(
+        "Invoice confirmed",
+        extra={"invoice_id": str(invoice.id), "user_id": str(user.id)},
+    )
+    invoice.status = "confirmed"
+    if invoice.confirmed_at is None:
+        invoice.confirmed_at = now
+    return build_outbox_event(
+        user.id, invoice, "invoice.confirmed", ("InvoiceSettled", "InvoicePaymentSettled")
+    )
 
 
 def _sync_invoice_transfers(
@@ -206,58 +372,62 @@ def _sync_invoice_transfers(
     *,
     invoice: Invoice,
     transfers: list[TransferDetail],
+    existing: list[InvoiceTransfer],
 ) -> bool:
-    existing = (
-        db.query(InvoiceTransfer)
-        .filter(InvoiceTransfer.invoice_id == invoice.id)
-        .all()
-    )
-    existing_by_txid = {transfer.txid: transfer for transfer in existing if transfer.txid}
-    seen_txids: set[str] = set()
-    changed = False
-    for transfer in transfers:
-        txid = transfer.txid
-        if not txid:
-            continue
-        seen_txids.add(txid)
-        stored = existing_by_txid.get(txid)
-        if stored is None:
-            db.add(
-                InvoiceTransfer(
-                    invoice_id=invoice.id,
-                    txid=txid,
-                    amount_atomic=transfer.amount_atomic,
-                    confirmations=transfer.confirmations,
-                    timestamp=transfer.timestamp,
-                    address=transfer.address,
-                )
-            )
-            changed = True
-            continue
-        if (
-            stored.amount_atomic != transfer.amount_atomic
-            or stored.confirmations != transfer.confirmations
-            or stored.timestamp != transfer.timestamp
-            or stored.address != transfer.address
-        ):
-            stored.amount_atomic = transfer.amount_atomic
-            stored.confirmations = transfer.confirmations
-            stored.timestamp = transfer.timestamp
-            stored.address = transfer.address
-            changed = True
-    for stored in existing:
-        if stored.txid not in seen_txids:
-            db.delete(stored)
+    incoming = {
+        transfer.txid: (
+            transfer.amount_atomic,
+            transfer.confirmations,
+            transfer.timestamp,
+            transfer.address,
+        )
+        for transfer in transfers
+        if transfer.txid
+    }
+    existing_by_txid = {stored.txid: stored for stored in existing if stored.txid}
+    new_txids = [txid for txid in incoming if txid not in existing_by_txid]
+    stale_ids = [stored.id for stored in existing if stored.txid not in incoming]
+    changed = bool(new_txids or stale_ids)
+    for txid in incoming.keys() & existing_by_txid.keys():
+        stored = existing_by_txid[txid]
+        values = incoming[txid]
+        if (stored.amount_atomic, stored.confirmations, stored.timestamp, stored.address) != values:
+            (
+                stored.amount_atomic,
+                stored.confirmations,
+                stored.timestamp,
+                stored.address,
+            ) = values
             changed = True
+    if new_txids:
+        db.execute(
+            insert(InvoiceTransfer),
+            [
+                {
+                    "invoice_id": invoice.id,
+                    "txid": txid,
+                    "amount_atomic": incoming[txid][0],
+                    "confirmations": incoming[txid][1],
+                    "timestamp": incoming[txid][2],
+                    "address": incoming[txid][3],
+                }
+                for txid in new_txids
+            ],
+        )
+    if stale_ids:
+        db.execute(
+            delete(InvoiceTransfer)
+            .where(InvoiceTransfer.id.in_(stale_ids))
+            .execution_options(synchronize_session=False)
+        )
     return changed
 
 
 
 
+@lru_cache(maxsize=4096)
 def _xmr_to_atomic(amount: Decimal) -> int:
-    quantized = (Decimal(amount) * Decimal("1000000000000")).to_integral_value(
-        rounding=ROUND_DOWN
-    )
+    quantized = (Decimal(amount) * _ATOMIC_PER_XMR).to_integral_value(rounding=ROUND_DOWN)
     return int(quantized)
 
 
@@ -1,16 +1,24 @@
 import uuid
 from typing import Any
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal, ROUND_DOWN, InvalidOperation
+from decimal import Decimal, InvalidOperation
 import csv
 import io
 import json
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
 from fastapi.responses import RedirectResponse, StreamingResponse
-import requests
 from requests import RequestException
-from sqlalchemy import func, or_
+from sqlalchemy import func, insert, or_, text
 from sqlalchemy.sql import cast
 from sqlalchemy.types import String as SqlString
 from sqlalchemy.orm import Session
@@ -25,10 +33,11 @@ from .config import (
     QR_STORAGE_DIR,
 )
 from .db import get_db
-from .formatting import format_xmr_amount
+from .formatting import format_xmr_amount, format_xmr_atomic
+from .http_client import http_session
 from .models import Invoice, ProfileHistory, User, Webhook, WebhookDelivery
 from monero.address import Address, IntegratedAddress, SubAddress
-from .rates import get_xmr_rate
+from .rates import fiat_to_xmr, get_xmr_rate
 from .subaddress_allocator import MAX_SUBADDRESS_INDEX, create_subaddress_for_user
 from .schemas import (
     ApiCredentialsResetRequest,
@@ -67,6 +76,7 @@ WEBHOOK_EVENTS = (
     "invoice.confirmed",
     "invoice.expired",
 )
+_WEBHOOK_EVENT_SET = frozenset(WEBHOOK_EVENTS)
 
 
 def _require_donations_enabled() -> None:
@@ -77,6 +87,7 @@ def _require_donations_enabled() -> None:
 )
 
 MAX_QR_LOGO_DATA_URL_LENGTH = 120_000
+_CSV_EXPORT_BATCH_SIZE = 500
 
 
 def _get_user_for_api_key(db: Session, api_key: str) -> User | None:
@@ -161,21 +172,12 @@ def _resolve_webhook_payload(
 ) -> tuple[str | None, list[str], dict[str, str] | None]:
     event_urls = {key: str(value) for key, value in (payload.event_urls or {}).items()}
     events = list(payload.events or [])
-    if event_urls:
-        for key in event_urls:
-            if key not in WEBHOOK_EVENTS:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Webhook event is not supported",
-                )
-    if events:
-        for event in events:
-            if event not in WEBHOOK_EVENTS:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Webhook event is not supported",
-                )
-    events_set = set(events) | set(event_urls.keys())
+    events_set = set(events).union(event_urls)
+    if not events_set <= _WEBHOOK_EVENT_SET:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Webhook event is not supported",
+        )
     if not events_set:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -197,21 +199,21 @@ def _resolve_webhook_payload(
     return (str(payload.url) if payload.url else None, ordered_events, event_urls or None)
 
 
-def _invoice_url(invoice: Invoice, request: Request) -> str:
-    proto = request.headers.get("x-forwarded-proto", request.url.scheme)
-    host = request.headers.get("x-forwarded-host", request.headers.get("host", ""))
+def _base_url(request: Request) -> str:
+    # Empty when no host header is present, so callers fall back to relative paths.
+    headers = request.headers
+    host = headers.get("x-forwarded-host", headers.get("host", ""))
     if not host:
-        return f"/invoice/{invoice.id}"
-    return f"{proto}://{host}/invoice/{invoice.id}"
+        return ""
+    return f"{headers.get('x-forwarded-proto', request.url.scheme)}://{host}"
 
 
-def _qr_url(invoice: Invoice, request: Request) -> str:
-    proto = request.headers.get("x-forwarded-proto", request.url.scheme)
-    host = request.headers.get("x-forwarded-host", request.headers.get("host", ""))
-    path = invoice_qr_url(str(invoice.id))
-    if not host:
-        return path
-    return f"{proto}://{host}{path}"
+def _invoice_url(invoice: Invoice, base_url: str) -> str:
+    return f"{base_url}/invoice/{invoice.id}"
+
+
+def _qr_url(invoice: Invoice, base_url: str) -> str:
+    return f"{base_url}{invoice_qr_url(str(invoice.id))}"
 
 
 def _invoice_response(
@@ -234,10 +236,11 @@ def _invoice_response(
         qr_logo_data_url = None
     if not isinstance(qr_logo_data_url, str):
         qr_logo_data_url = None
+    base_url = _base_url(request)
     return response.model_copy(
         update={
-            "invoice_url": _invoice_url(invoice, request),
-            "qr_url": _qr_url(invoice, request),
+            "invoice_url": _invoice_url(invoice, base_url),
+            "qr_url": _qr_url(invoice, base_url),
             "warnings": warnings,
             "quote": quote,
             "qr_logo": qr_logo,
@@ -246,19 +249,33 @@ def _invoice_response(
     )
 
 
-def _public_invoice_status_response(
+def _get_invoice_with_checkout_style(
     db: Session,
+    invoice_id: uuid.UUID,
+) -> tuple[Invoice | None, str | None]:
+    # The public status response only needs the owner's checkout style, so it is joined
+    # in here rather than loading the whole user afterwards.
+    row = (
+        db.query(Invoice, User.btcpay_checkout_style)
+        .outerjoin(User, User.id == Invoice.user_id)
+        .filter(Invoice.id == invoice_id)
+        .first()
+    )
+    if row is None:
+        return None, None
+    return row[0], row[1]
+
+
+def _public_invoice_status_response(
     invoice: Invoice,
     request: Request,
+    btcpay_checkout_style: str | None,
 ) -> InvoiceStatusResponse:
     response = InvoiceStatusResponse.model_validate(invoice)
     metadata = invoice.metadata_json or {}
     update: dict[str, Any] = {}
     if invoice.total_paid_atomic is not None:
-        total_paid = (Decimal(invoice.total_paid_atomic) / Decimal("1000000000000")).quantize(
-            Decimal("0.000000000001"), rounding=ROUND_DOWN
-        )
-        update["amount_paid_xmr"] = format_xmr_amount(total_paid)
+        update["amount_paid_xmr"] = format_xmr_atomic(invoice.total_paid_atomic)
     btcpay_data = metadata.get("btcpay") if isinstance(metadata, dict) else None
     if isinstance(btcpay_data, dict):
         amount = btcpay_data.get("amount")
@@ -266,10 +283,8 @@ def _public_invoice_status_response(
         if isinstance(amount, str) and isinstance(currency, str):
             update["btcpay_amount"] = amount
             update["btcpay_currency"] = currency
-            if invoice.user_id:
-                user = db.query(User).filter(User.id == invoice.user_id).first()
-                if user and user.btcpay_checkout_style:
-                    update["btcpay_checkout_style"] = user.btcpay_checkout_style
+            if btcpay_checkout_style:
+                update["btcpay_checkout_style"] = btcpay_checkout_style
         checkout = btcpay_data.get("checkout")
         if isinstance(checkout, dict):
             redirect_url = checkout.get("redirectURL")
@@ -306,10 +321,21 @@ def _public_invoice_status_response(
     update["checkout_continue_available"] = bool(
         invoice.status == "confirmed" and continue_url
     )
-    update["qr_url"] = _qr_url(invoice, request)
+    update["qr_url"] = _qr_url(invoice, _base_url(request))
     return response.model_copy(update=update)
 
 
+def _ensure_qr_png_quietly(invoice: Invoice) -> None:
+    try:
+        ensure_invoice_qr_png(
+            invoice=invoice,
+            storage_dir=QR_STORAGE_DIR,
+            settings=resolve_qr_settings(invoice),
+        )
+    except HTTPException:
+        pass
+
+
 def _resolve_invoice_amount(
     db: Session,
     *,
@@ -342,9 +368,7 @@ def _resolve_invoice_amount(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Fiat quote service unavailable",
         ) from exc
-    amount_xmr = (Decimal(requested_amount_fiat) / quote.rate).quantize(
-        Decimal("0.000000000001"), rounding=ROUND_DOWN
-    )
+    amount_xmr = fiat_to_xmr(requested_amount_fiat, quote)
     warnings = ["Fiat conversion is an estimate and does not lock a rate."]
     quote_payload = {
         "fiat_amount": str(requested_amount_fiat),
@@ -394,6 +418,7 @@ def _validate_payment_address_and_view_key(payment_address: str, view_key: str)
 def create_donation_invoice(
     payload: DonationCreate,
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
 ):
     _require_donations_enabled()
@@ -401,15 +426,21 @@ def create_donation_invoice(
     expires_at = _donation_invoice_expiry()
     active_limit = min(max(1, DONATION_ACTIVE_INVOICE_LIMIT), MAX_SUBADDRESS_INDEX)
     now = datetime.now(timezone.utc)
+    # Serializes the limit check with the insert below; released when the transaction ends.
+    db.execute(
+        text("SELECT pg_advisory_xact_lock(:lock_id)"),
+        {"lock_id": user.id.int & 0x7FFFFFFF},
+    )
+    # Counting stops at the limit; only whether it is reached matters.
     active_count = (
-        db.query(func.count(Invoice.id))
+        db.query(Invoice.id)
         .filter(
             Invoice.user_id == user.id,
             Invoice.status.in_(["pending", "payment_detected"]),
             or_(Invoice.expires_at.is_(None), Invoice.expires_at > now),
         )
-        .scalar()
-        or 0
+        .limit(active_limit)
+        .count()
     )
     if active_count >= active_limit:
         raise HTTPException(
@@ -436,14 +467,9 @@ def create_donation_invoice(
     db.add(invoice)
     db.commit()
     db.refresh(invoice)
-    try:
-        ensure_invoice_qr_png(
-            invoice=invoice,
-            storage_dir=QR_STORAGE_DIR,
-            settings=resolve_qr_settings(invoice),
-        )
-    except HTTPException:
-        pass
+    # The donation page polls the status endpoint, which renders the QR on
+    # demand, so the render does not need to block this response.
+    background_tasks.add_task(_ensure_qr_png_quietly, invoice)
     return _invoice_response(invoice, request, warnings=warnings)
 
 
@@ -456,7 +482,7 @@ def get_invoice_status(
     request: Request,
     db: Session = Depends(get_db),
 ):
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    invoice, checkout_style = _get_invoice_with_checkout_style(db, invoice_id)
     if invoice is None or _is_donation_invoice(invoice):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -470,7 +496,7 @@ def get_invoice_status(
         )
     except HTTPException:
         pass
-    return _public_invoice_status_response(db, invoice, request)
+    return _public_invoice_status_response(invoice, request, checkout_style)
 
 
 @router.get(
@@ -515,7 +541,7 @@ def get_donation_status(
 ):
     _require_donations_enabled()
     founder = _get_founder_user(db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    invoice, checkout_style = _get_invoice_with_checkout_style(db, invoice_id)
     if (
         invoice is None
         or not _is_donation_invoice(invoice)
@@ -533,7 +559,7 @@ def get_donation_status(
         )
     except HTTPException:
         pass
-    return _public_invoice_status_response(db, invoice, request)
+    return _public_invoice_status_response(invoice, request, checkout_style)
 
 
 @router.post("/api/core/webhooks", response_model=WebhookResponse)
@@ -652,7 +678,7 @@ def redeliver_webhook_delivery(
     status_code = None
     error_message = None
     try:
-        response = requests.post(
+        response = http_session.post(
             delivery.url,
             json=payload,
             headers={"X-Webhook-Secret": webhook_secret},
@@ -791,33 +817,37 @@ def reset_api_credentials(
             detail="Select at least one credential to reset",
         )
     response: dict[str, str] = {}
+    history_rows: list[dict[str, Any]] = []
     if payload.reset_api_key:
         new_key = generate_api_key()
         new_key_encrypted = encrypt_api_key(new_key)
-        history_entry = ProfileHistory(
-            user_id=user.id,
-            field_name="api_key",
-            old_value=user.api_key_encrypted,
-            new_value=new_key_encrypted,
-            value_encrypted=True,
+        history_rows.append(
+            {
+                "user_id": user.id,
+                "field_name": "api_key",
+                "old_value": user.api_key_encrypted,
+                "new_value": new_key_encrypted,
+                "value_encrypted": True,
+            }
         )
         user.api_key_hash = hash_api_key(new_key)
         user.api_key_encrypted = new_key_encrypted
-        db.add(history_entry)
         response["api_key"] = new_key
     if payload.reset_webhook_secret:
         new_secret = generate_webhook_secret()
         new_secret_encrypted = encrypt_secret(new_secret)
-        history_entry = ProfileHistory(
-            user_id=user.id,
-            field_name="webhook_secret",
-            old_value=user.webhook_secret_encrypted,
-            new_value=new_secret_encrypted,
-            value_encrypted=True,
+        history_rows.append(
+            {
+                "user_id": user.id,
+                "field_name": "webhook_secret",
+                "old_value": user.webhook_secret_encrypted,
+                "new_value": new_secret_encrypted,
+                "value_encrypted": True,
+            }
         )
         user.webhook_secret_encrypted = new_secret_encrypted
-        db.add(history_entry)
         response["webhook_secret"] = new_secret
+    db.execute(insert(ProfileHistory), history_rows)
     db.commit()
     db.refresh(user)
     return response
@@ -854,44 +884,48 @@ def update_profile(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Select at least one profile field to update",
         )
+    history_rows: list[dict[str, Any]] = []
     if (
         "btcpay_checkout_style" in payload.model_fields_set
         and payload.btcpay_checkout_style != user.btcpay_checkout_style
     ):
-        history_entry = ProfileHistory(
-            user_id=user.id,
-            field_name="btcpay_checkout_style",
-            old_value=user.btcpay_checkout_style,
-            new_value=payload.btcpay_checkout_style,
-            value_encrypted=False,
+        history_rows.append(
+            {
+                "user_id": user.id,
+                "field_name": "btcpay_checkout_style",
+                "old_value": user.btcpay_checkout_style,
+                "new_value": payload.btcpay_checkout_style,
+                "value_encrypted": False,
+            }
         )
         user.btcpay_checkout_style = payload.btcpay_checkout_style
-        db.add(history_entry)
     if (
         "default_confirmation_target" in payload.model_fields_set
         and payload.default_confirmation_target is not None
         and payload.default_confirmation_target != user.default_confirmation_target
     ):
-        history_entry = ProfileHistory(
-            user_id=user.id,
-            field_name="default_confirmation_target",
-            old_value=str(user.default_confirmation_target),
-            new_value=str(payload.default_confirmation_target),
-            value_encrypted=False,
+        history_rows.append(
+            {
+                "user_id": user.id,
+                "field_name": "default_confirmation_target",
+                "old_value": str(user.default_confirmation_target),
+                "new_value": str(payload.default_confirmation_target),
+                "value_encrypted": False,
+            }
         )
         user.default_confirmation_target = payload.default_confirmation_target
-        db.add(history_entry)
     if "default_qr_logo" in payload.model_fields_set:
         if payload.default_qr_logo is not None and payload.default_qr_logo != user.default_qr_logo:
-            history_entry = ProfileHistory(
-                user_id=user.id,
-                field_name="default_qr_logo",
-                old_value=user.default_qr_logo,
-                new_value=payload.default_qr_logo,
-                value_encrypted=False,
+            history_rows.append(
+                {
+                    "user_id": user.id,
+                    "field_name": "default_qr_logo",
+                    "old_value": user.default_qr_logo,
+                    "new_value": payload.default_qr_logo,
+                    "value_encrypted": False,
+                }
             )
             user.default_qr_logo = payload.default_qr_logo
-            db.add(history_entry)
     if "default_qr_logo_data_url" in payload.model_fields_set:
         if payload.default_qr_logo_data_url is not None:
             value = payload.default_qr_logo_data_url.strip()
@@ -903,15 +937,18 @@ def update_profile(
             if value == "":
                 payload.default_qr_logo_data_url = None
         if payload.default_qr_logo_data_url != user.default_qr_logo_data_url:
-            history_entry = ProfileHistory(
-                user_id=user.id,
-                field_name="default_qr_logo_data_url",
-                old_value=user.default_qr_logo_data_url,
-                new_value=payload.default_qr_logo_data_url,
-                value_encrypted=False,
+            history_rows.append(
+                {
+                    "user_id": user.id,
+                    "field_name": "default_qr_logo_data_url",
+                    "old_value": user.default_qr_logo_data_url,
+                    "new_value": payload.default_qr_logo_data_url,
+                    "value_encrypted": False,
+                }
             )
             user.default_qr_logo_data_url = payload.default_qr_logo_data_url
-            db.add(history_entry)
+    if history_rows:
+        db.execute(insert(ProfileHistory), history_rows)
     db.add(user)
     db.commit()
     db.refresh(user)
@@ -1201,7 +1238,9 @@ def export_invoices_csv(
         buffer.seek(0)
         buffer.truncate(0)
 
-        for invoice in query.yield_per(500):
+        # Flushing once per fetched batch keeps memory bounded without paying an
+        # iterate-in-threadpool hop and a response chunk for every row.
+        for position, invoice in enumerate(query.yield_per(_CSV_EXPORT_BATCH_SIZE), 1):
             metadata = invoice.metadata_json
             if metadata is None:
                 metadata_value = ""
@@ -1228,9 +1267,13 @@ def export_invoices_csv(
                     metadata_value,
                 ]
             )
-            yield buffer.getvalue()
-            buffer.seek(0)
-            buffer.truncate(0)
+            if position % _CSV_EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        remainder = buffer.getvalue()
+        if remainder:
+            yield remainder
 
     filename = f"invoices-{datetime.now(timezone.utc).date().isoformat()}.csv"
     headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
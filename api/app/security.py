@@ -1,5 +1,6 @@
 import hashlib
 import secrets
+from functools import lru_cache
 
 from fastapi import Depends, Header, HTTPException, status
 from passlib.context import CryptContext
@@ -31,7 +32,7 @@ def require_api_key(
     db: Session = Depends(get_db),
 ) -> str:
     api_key = _parse_authorization_api_key(authorization) or x_api_key
-    if api_key is None or api_key not in API_KEYS:
+    if api_key is None or not _is_configured_api_key(api_key):
         if api_key is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -47,6 +48,14 @@ def require_api_key(
     return api_key
 
 
+def _is_configured_api_key(api_key: str) -> bool:
+    provided = api_key.encode("utf-8")
+    matched = False
+    for key in API_KEYS:
+        matched |= secrets.compare_digest(provided, key.encode("utf-8"))
+    return matched
+
+
 def hash_password(password: str) -> str:
     return _pwd_context.hash(password)
 
@@ -75,15 +84,18 @@ def decrypt_api_key(api_key_encrypted: str) -> str:
     return decrypt_secret(api_key_encrypted)
 
 
-def encrypt_secret(value: str) -> str:
+@lru_cache(maxsize=1)
+def _fernet():
     from cryptography.fernet import Fernet
 
-    return Fernet(API_KEY_ENCRYPTION_KEY).encrypt(value.encode("utf-8")).decode("utf-8")
+    return Fernet(API_KEY_ENCRYPTION_KEY)
 
 
-def decrypt_secret(value_encrypted: str) -> str:
-    from cryptography.fernet import Fernet
+def encrypt_secret(value: str) -> str:
+    return _fernet().encrypt(value.encode("utf-8")).decode("utf-8")
 
-    return Fernet(API_KEY_ENCRYPTION_KEY).decrypt(
-        value_encrypted.encode("utf-8")
-    ).decode("utf-8")
+
+@lru_cache(maxsize=2048)
+def decrypt_secret(value_encrypted: str) -> str:
+    # Fernet tokens carry their own IV, so a ciphertext always maps to one plaintext.
+    return _fernet().decrypt(value_encrypted.encode("utf-8")).decode("utf-8")
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, exists, insert, or_, update
+from sqlalchemy.orm import Session, aliased
+
+from .btcpay_webhooks import build_btcpay_payload, encode_btcpay_body, queue_btcpay_body
+from .db import SessionLocal
+from .models import Invoice, WebhookOutbox
+from .webhooks import build_webhook_payload, deliver_webhook_payload
+
+logger = logging.getLogger(__name__)
+
+_BATCH_SIZE = 100
+_IDLE_SLEEP_SECONDS = 1.0
+# Covers a user's whole claimed batch; a claim left by a crashed process is picked up
+# again once it lapses, so delivery is at least once.
+_CLAIM_SECONDS = 600
+_FAILED_RETRY_SECONDS = 30
+_MAX_USER_LANES = 8
+
+# One lane per user keeps that user's events in order; users in flight here are not
+# claimed again until their lane finishes.
+_user_lanes = ThreadPoolExecutor(max_workers=_MAX_USER_LANES, thread_name_prefix="webhook-outbox")
+_busy_users_lock = threading.Lock()
+_busy_users: set[object] = set()
+
+
+def build_outbox_event(
+    user_id: object,
+    invoice: Invoice,
+    event: str,
+    btcpay_events: tuple[str, ...],
+) -> dict[str, object]:
+    # Payloads are rendered when the event is raised, so a later transition in the same
+    # pass does not leak into an earlier event.
+    return {
+        "user_id": user_id,
+        "invoice_id": invoice.id,
+        "event": event,
+        "payload": build_webhook_payload(event, invoice),
+        # Stored as the encoded body that will be sent, so the JSON column only ever
+        # holds strings whatever the payload carries.
+        "btcpay_payloads": [
+            {
+                "type": btcpay_event,
+                "body": encode_btcpay_body(
+                    build_btcpay_payload(
+                        event_type=btcpay_event,
+                        user_id=str(user_id),
+                        invoice=invoice,
+                        manually_marked=False,
+                    )
+                ).decode("utf-8"),
+            }
+            for btcpay_event in btcpay_events
+        ],
+    }
+
+
+def enqueue_webhook_events(db: Session, events: list[dict[str, object]]) -> None:
+    # Runs inside the caller's transaction, so events are stored atomically with the
+    # invoice changes that raised them.
+    if not events:
+        return
+    db.execute(insert(WebhookOutbox), events)
+
+
+def start_outbox_worker() -> threading.Thread:
+    worker = threading.Thread(target=_run_outbox_worker, name="webhook-outbox", daemon=True)
+    worker.start()
+    return worker
+
+
+def _run_outbox_worker() -> None:
+    while True:
+        try:
+            claimed = claim_pending_webhooks()
+        except Exception as exc:
+            logger.exception("Webhook outbox claim failed: %s", exc)
+            claimed = 0
+        if not claimed:
+            time.sleep(_IDLE_SLEEP_SECONDS)
+
+
+def claim_pending_webhooks() -> int:
+    db: Session = SessionLocal(expire_on_commit=False)
+    try:
+        now = datetime.now(timezone.utc)
+        claimed = aliased(WebhookOutbox)
+        query = db.query(WebhookOutbox).filter(
+            or_(WebhookOutbox.claimed_until.is_(None), WebhookOutbox.claimed_until < now),
+            # Another process still holds earlier events for this user.
+            ~exists().where(
+                claimed.user_id == WebhookOutbox.user_id,
+                claimed.claimed_until >= now,
+            ),
+        )
+        with _busy_users_lock:
+            busy_users = list(_busy_users)
+        if busy_users:
+            query = query.filter(WebhookOutbox.user_id.not_in(busy_users))
+        rows = (
+            query.order_by(WebhookOutbox.id.asc())
+            .limit(_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not rows:
+            return 0
+        db.execute(
+            update(WebhookOutbox)
+            .where(WebhookOutbox.id.in_([row.id for row in rows]))
+            .values(claimed_until=now + timedelta(seconds=_CLAIM_SECONDS))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+    user_rows: dict[object, list[WebhookOutbox]] = {}
+    for row in rows:
+        user_rows.setdefault(row.user_id, []).append(row)
+    with _busy_users_lock:
+        _busy_users.update(user_rows)
+    for user_id, pending in user_rows.items():
+        _user_lanes.submit(_deliver_user_events, user_id, pending)
+    return len(rows)
+
+
+def _deliver_user_events(user_id: object, rows: list[WebhookOutbox]) -> None:
+    db: Session = SessionLocal()
+    delivered = 0
+    try:
+        user_key = str(user_id)
+        for row in rows:
+            deliver_webhook_payload(db, user_key, row.payload)
+            wait(
+                [
+                    future
+                    for btcpay in row.btcpay_payloads or ()
+                    for future in queue_btcpay_body(
+                        db, user_key, btcpay["type"], btcpay["body"].encode("utf-8")
+                    )
+                ]
+            )
+            # Removed only after every send for the event has finished.
+            db.execute(delete(WebhookOutbox).where(WebhookOutbox.id == row.id))
+            db.commit()
+            delivered += 1
+    except Exception as exc:
+        logger.exception("Webhook outbox delivery failed: %s", exc)
+        db.rollback()
+        _defer_claims(db, [row.id for row in rows[delivered:]])
+    finally:
+        db.close()
+        with _busy_users_lock:
+            _busy_users.discard(user_id)
+
+
+def _defer_claims(db: Session, row_ids: list[int]) -> None:
+    # The remaining events stay claimed for a short while, so a failing row is retried
+    # without spinning and later events for the user still wait behind it.
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=_FAILED_RETRY_SECONDS)
+    try:
+        db.execute(
+            update(WebhookOutbox)
+            .where(WebhookOutbox.id.in_(row_ids))
+            .values(claimed_until=retry_at)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except Exception as exc:
+        db.rollback()
+        logger.warning("Failed to defer webhook outbox claims", extra={"error": str(exc)})
@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import uuid
 from datetime import datetime
+from decimal import Decimal
+from typing import Any
 
-import requests
 from requests import RequestException
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from .formatting import format_xmr_amount
+from .http_client import http_session
 from .models import Invoice, User, Webhook, WebhookDelivery
 from .security import decrypt_secret, encrypt_secret, generate_webhook_secret
 
 logger = logging.getLogger(__name__)
 
+_MAX_DISPATCH_WORKERS = 8
+
+_delivery_pool = ThreadPoolExecutor(
+    max_workers=_MAX_DISPATCH_WORKERS, thread_name_prefix="webhook-delivery"
+)
+
 
 def build_webhook_payload(event: str, invoice: Invoice) -> dict[str, object]:
     return {
@@ -43,6 +53,16 @@ def dispatch_webhooks(
     event: str,
     invoice: Invoice,
 ) -> None:
+    deliver_webhook_payload(db, user_id, build_webhook_payload(event, invoice))
+
+
+def deliver_webhook_payload(
+    db: Session,
+    user_id: str,
+    payload: dict[str, Any],
+) -> None:
+    event = payload["event"]
+    invoice_data = payload["invoice"]
     hooks = (
         db.query(Webhook)
         .filter(
@@ -55,9 +75,8 @@ def dispatch_webhooks(
     webhook_secret = None
     if user is not None:
         webhook_secret = _ensure_webhook_secret(db, user)
-    payload = build_webhook_payload(event, invoice)
-    deliveries: list[WebhookDelivery] = []
     user_uuid = uuid.UUID(user_id)
+    targets: list[tuple[Webhook, str]] = []
     for hook in hooks:
         if event not in hook.events:
             continue
@@ -69,38 +88,47 @@ def dispatch_webhooks(
                 extra={"webhook_id": str(hook.id), "event": event},
             )
             continue
-        status_code = None
-        error_message = None
+        targets.append((hook, target_url))
+    headers = {"X-Webhook-Secret": webhook_secret} if webhook_secret else None
+
+    def _post(target: tuple[Webhook, str]) -> tuple[int | None, str | None]:
+        hook, target_url = target
         try:
-            headers = {"X-Webhook-Secret": webhook_secret} if webhook_secret else None
-            response = requests.post(target_url, json=payload, headers=headers, timeout=5)
-            status_code = response.status_code
+            response = http_session.post(target_url, json=payload, headers=headers, timeout=5)
+            return response.status_code, None
         except RequestException as exc:
-            error_message = str(exc)
             logger.warning(
                 "Webhook delivery failed",
                 extra={"webhook_id": str(hook.id), "event": event},
             )
             logger.debug("Webhook delivery error: %s", exc)
-        deliveries.append(
-            WebhookDelivery(
-                user_id=user_uuid,
-                webhook_id=hook.id,
-                event=event,
-                url=target_url,
-                invoice_id=invoice.id,
-                invoice_address=invoice.address,
-                invoice_subaddress_index=invoice.subaddress_index,
-                invoice_amount_xmr=invoice.amount_xmr,
-                invoice_status=invoice.status,
-                payload_json=payload,
-                http_status=status_code,
-                error_message=error_message,
-            )
-        )
+            return None, str(exc)
+
+    if len(targets) > 1:
+        results = list(_delivery_pool.map(_post, targets))
+    else:
+        results = [_post(target) for target in targets]
+    invoice_id = uuid.UUID(invoice_data["id"])
+    deliveries = [
+        {
+            "user_id": user_uuid,
+            "webhook_id": hook.id,
+            "event": event,
+            "url": target_url,
+            "invoice_id": invoice_id,
+            "invoice_address": invoice_data["address"],
+            "invoice_subaddress_index": invoice_data["subaddress_index"],
+            "invoice_amount_xmr": Decimal(invoice_data["amount_xmr"]),
+            "invoice_status": invoice_data["status"],
+            "payload_json": payload,
+            "http_status": status_code,
+            "error_message": error_message,
+        }
+        for (hook, target_url), (status_code, error_message) in zip(targets, results)
+    ]
     if deliveries:
         try:
-            db.add_all(deliveries)
+            db.execute(insert(WebhookDelivery), deliveries)
             db.commit()
         except Exception as exc:
             db.rollback()